@@ -1,5 +1,5 @@
 from fastapi import FastAPI, UploadFile, File, WebSocket, Form, HTTPException, Depends
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
@@ -9,15 +9,31 @@ from datetime import datetime
 import socket
 from fastapi import Request
 import json
-from starlette.responses import StreamingResponse
+from starlette.responses import StreamingResponse, Response
 import asyncio
 import aiofiles
 from typing import Dict, List, Optional
 import uuid
 from dataclasses import dataclass, asdict
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import secrets
 import base64
+import hashlib
+import mimetypes
+import zipfile
+import tarfile
+import sqlite3
+import threading
+import posixpath
+import contextlib
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import struct
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
 
 # 配置FastAPI应用，优化大文件上传
 app = FastAPI(
@@ -123,6 +139,211 @@ if not os.path.exists(UPLOAD_DIR):
 if not os.path.exists(CHAT_HISTORY_DIR):
     os.makedirs(CHAT_HISTORY_DIR)
 
+# 断点续传的临时文件目录（放在UPLOAD_DIR内，保证完成时可以原子重命名）
+PARTIAL_UPLOAD_DIR = os.path.join(UPLOAD_DIR, ".partial")
+if not os.path.exists(PARTIAL_UPLOAD_DIR):
+    os.makedirs(PARTIAL_UPLOAD_DIR)
+
+# 内容寻址的去重存储：相同内容(SHA-256)只保存一份，用户看到的路径是指向它的硬链接
+BLOB_DIR = os.path.join(UPLOAD_DIR, ".blobs")
+if not os.path.exists(BLOB_DIR):
+    os.makedirs(BLOB_DIR)
+
+# 回收站：删除只是把文件/文件夹重命名到这里，保留期内可以恢复
+TRASH_DIR = os.path.join(UPLOAD_DIR, ".trash")
+if not os.path.exists(TRASH_DIR):
+    os.makedirs(TRASH_DIR)
+
+# 文件I/O线程池：所有阻塞的文件系统操作都在这里执行，不占用事件循环，
+# 大文件夹的删除、哈希计算等不会让聊天WebSocket卡住
+IO_EXECUTOR_WORKERS = int(os.environ.get("IO_EXECUTOR_WORKERS", "8"))
+IO_MAX_PENDING = IO_EXECUTOR_WORKERS * 8  # run_io 最多同时提交的任务数，超出的在事件循环中等待
+IO_LATENCY_SAMPLES = 1024
+
+class IOExecutor(ThreadPoolExecutor):
+    """有界的文件I/O线程池，记录排队深度、等待时间和执行时间"""
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix="file-io")
+        self.stats_lock = threading.Lock()
+        self.waiting = 0  # 在 run_io 中等待提交的任务（只在事件循环线程中修改）
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queued = 0
+        self.wait_times = deque(maxlen=IO_LATENCY_SAMPLES)
+        self.run_times = deque(maxlen=IO_LATENCY_SAMPLES)
+    
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.perf_counter()
+        with self.stats_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        
+        def timed_call():
+            started_at = time.perf_counter()
+            with self.stats_lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_times.append(started_at - submitted_at)
+            succeeded = False
+            try:
+                result = fn(*args, **kwargs)
+                succeeded = True
+                return result
+            finally:
+                with self.stats_lock:
+                    self.running -= 1
+                    self.completed += 1
+                    if not succeeded:
+                        self.failed += 1
+                    self.run_times.append(time.perf_counter() - started_at)
+        
+        return super().submit(timed_call)
+    
+    @staticmethod
+    def _summarize(samples) -> dict:
+        if not samples:
+            return {"p50_ms": 0, "p95_ms": 0, "max_ms": 0}
+        ordered = sorted(samples)
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 3)
+        return {"p50_ms": percentile(0.5), "p95_ms": percentile(0.95), "max_ms": round(ordered[-1] * 1000, 3)}
+    
+    def snapshot(self) -> dict:
+        with self.stats_lock:
+            return {
+                "workers": self._max_workers,
+                "max_pending": IO_MAX_PENDING,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "running": self.running,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "queue_wait": self._summarize(self.wait_times),
+                "run_time": self._summarize(self.run_times)
+            }
+
+io_executor = IOExecutor(IO_EXECUTOR_WORKERS)
+io_slots = asyncio.Semaphore(IO_MAX_PENDING)
+
+async def run_io(func, *args, **kwargs):
+    """在文件I/O线程池中执行阻塞函数并等待结果"""
+    io_executor.waiting += 1
+    try:
+        await io_slots.acquire()
+    finally:
+        io_executor.waiting -= 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            io_executor, functools.partial(func, *args, **kwargs)
+        )
+    finally:
+        io_slots.release()
+
+def remove_if_exists(path: str) -> bool:
+    """删除文件，返回文件是否存在"""
+    if os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+# 文件列表中需要隐藏的内部文件/目录
+HIDDEN_ENTRY_NAMES = {".folder_meta", ".partial", ".blobs", ".jobs", ".trash"}
+
+def is_hidden_entry(name: str) -> bool:
+    """判断是否为元数据或内部使用的条目"""
+    return name.endswith('.meta') or name in HIDDEN_ENTRY_NAMES
+
+# 内容寻址存储函数
+def get_blob_path(sha256: str) -> str:
+    """根据SHA-256返回数据块路径"""
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise HTTPException(status_code=400, detail="无效的SHA-256")
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+def hash_file(file_path: str, on_chunk=None) -> str:
+    """计算文件的SHA-256，on_chunk(字节数) 在每读完一块后调用"""
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+            if on_chunk is not None:
+                on_chunk(len(chunk))
+    return hasher.hexdigest()
+
+def link_blob_to(sha256: str, file_path: str):
+    """把已有数据块硬链接到用户路径（先链接到临时名再替换，保证原子性）"""
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.linking"
+    os.link(get_blob_path(sha256), tmp_path)
+    os.replace(tmp_path, file_path)
+
+def store_blob(file_path: str, sha256: str) -> bool:
+    """把刚上传的文件放入去重存储，返回内容是否已存在（即本次被去重）"""
+    blob_path = get_blob_path(sha256)
+    try:
+        if os.path.exists(blob_path):
+            # 内容已存在：用户路径改为指向已有数据块，新写入的副本随之释放
+            link_blob_to(sha256, file_path)
+            return True
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.link(file_path, blob_path)
+    except OSError as e:
+        # 文件系统不支持硬链接时，保留普通文件即可
+        print(f"去重存储失败，保留普通文件 {file_path}: {e}")
+    return False
+
+def release_blob(sha256: Optional[str]):
+    """没有任何用户路径再引用数据块时删除它"""
+    if not sha256:
+        return
+    try:
+        blob_path = get_blob_path(sha256)
+        if os.path.exists(blob_path) and os.stat(blob_path).st_nlink <= 1:
+            os.remove(blob_path)
+    except (OSError, HTTPException) as e:
+        print(f"释放数据块 {sha256} 失败: {e}")
+
+def previous_blob_sha256(file_path: str) -> Optional[str]:
+    """即将被覆盖的文件引用的数据块（记录在它的 .meta 中），新内容写入后用 release_blob 释放"""
+    if not os.path.isfile(file_path):
+        return None
+    return read_file_metadata(file_path).get("sha256")
+
+def gc_orphan_blobs() -> int:
+    """清理不再被任何用户路径引用的数据块"""
+    removed = 0
+    for prefix in os.listdir(BLOB_DIR):
+        prefix_dir = os.path.join(BLOB_DIR, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for blob_name in os.listdir(prefix_dir):
+            blob_path = os.path.join(prefix_dir, blob_name)
+            try:
+                if os.stat(blob_path).st_nlink <= 1:
+                    os.remove(blob_path)
+                    removed += 1
+            except OSError as e:
+                print(f"清理数据块 {blob_name} 失败: {e}")
+    if removed:
+        print(f"清理无引用的数据块: {removed} 个")
+    return removed
+
+def read_file_metadata(file_path: str) -> dict:
+    """读取文件的 .meta 元数据，不存在或损坏时返回空字典"""
+    metadata_path = file_path + ".meta"
+    if os.path.exists(metadata_path):
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except:
+            pass
+    return {}
+
 # 文件夹管理函数
 def ensure_folder_exists(folder_path):
     """确保文件夹存在，如果不存在则创建"""
@@ -131,47 +352,760 @@ def ensure_folder_exists(folder_path):
         os.makedirs(full_path)
     return full_path
 
-def get_file_info(file_path, relative_path=""):
-    """获取文件或文件夹信息"""
-    is_dir = os.path.isdir(file_path)
-    name = os.path.basename(file_path)
+# 文件元数据索引：SQLite(WAL模式)按相对路径保存文件信息，
+# /files 的列表、排序和搜索直接查询索引，不再逐个 stat 和解析 .meta
+# .meta 文件只作为导入/导出格式：上传时照常写出，索引重建时从中导入
+FILE_INDEX_DB = os.path.join("database", "file_index.db")
+
+def normalize_relative_path(path: Optional[str]) -> str:
+    """规范化相对路径：统一使用 / 分隔，去掉首尾的 / 和 ."""
+    if not path:
+        return ""
+    path = posixpath.normpath(path.replace("\\", "/")).strip("/")
+    return "" if path == "." else path
+
+def to_relative_path(full_path: str) -> str:
+    """把UPLOAD_DIR下的完整路径转换为索引使用的相对路径"""
+    return normalize_relative_path(os.path.relpath(full_path, UPLOAD_DIR))
+
+def format_timestamp(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+class FileIndex:
+    COLUMNS = (
+        "path", "parent", "name", "type", "size", "created", "mtime_ns", "meta_mtime_ns",
+        "uploader_username", "uploader_ip", "comment", "original_name", "sha256", "file_count"
+    )
+    SORT_COLUMNS = {
+        "name": "name",
+        "time": "created",
+        "uploader_ip": "uploader_ip",
+        "size": "size"
+    }
     
-    if is_dir:
-        return {
-            "name": name,
-            "type": "folder",
+    def __init__(self, db_path: str):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # 与Python的str.lower保持一致，支持非ASCII字符的大小写不敏感搜索
+        self.conn.create_function("py_lower", 1, lambda s: s.lower() if s else "", deterministic=True)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    mtime_ns INTEGER,
+                    meta_mtime_ns INTEGER,
+                    uploader_username TEXT,
+                    uploader_ip TEXT,
+                    comment TEXT,
+                    original_name TEXT,
+                    sha256 TEXT,
+                    file_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            for column in ("name", "created", "uploader_ip", "size"):
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_files_parent_{column} ON files(parent, {column})"
+                )
+            columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(files)")]
+            if "file_count" not in columns:
+                # 旧版本索引库升级：增加文件数量列并一次性计算文件夹汇总
+                self.conn.execute("ALTER TABLE files ADD COLUMN file_count INTEGER NOT NULL DEFAULT 0")
+                self._rebuild_folder_stats()
+        self.fts_enabled = self._init_search_index()
+    
+    def _rebuild_folder_stats(self):
+        """重新计算所有文件夹的总大小和文件数量"""
+        self.conn.execute("UPDATE files SET file_count = 1 WHERE type = 'file'")
+        self.conn.execute("""
+            UPDATE files SET
+                size = (SELECT coalesce(sum(c.size), 0) FROM files AS c
+                        WHERE c.type = 'file' AND c.path >= files.path || '/' AND c.path < files.path || '0'),
+                file_count = (SELECT count(*) FROM files AS c
+                              WHERE c.type = 'file' AND c.path >= files.path || '/' AND c.path < files.path || '0')
+            WHERE type = 'folder'
+        """)
+    
+    SEARCH_COLUMNS = ("name", "original_name", "uploader_username", "comment")
+    
+    def _init_search_index(self) -> bool:
+        """创建全局搜索用的三元组(trigram)全文索引，由触发器随 files 表增量维护"""
+        columns = ", ".join(self.SEARCH_COLUMNS)
+        new_values = ", ".join(f"new.{c}" for c in self.SEARCH_COLUMNS)
+        old_values = ", ".join(f"old.{c}" for c in self.SEARCH_COLUMNS)
+        try:
+            with self.lock, self.conn:
+                created = self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'files_fts'"
+                ).fetchone() is None
+                self.conn.execute(f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                        {columns}, content='files', content_rowid='rowid', tokenize='trigram'
+                    )
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                        INSERT INTO files_fts(rowid, {columns}) VALUES (new.rowid, {new_values});
+                    END
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                        INSERT INTO files_fts(files_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+                    END
+                """)
+                # 只在被搜索的列变化时更新全文索引，文件夹汇总的频繁更新不会触发
+                self.conn.execute("DROP TRIGGER IF EXISTS files_fts_update")
+                self.conn.execute(f"""
+                    CREATE TRIGGER files_fts_update AFTER UPDATE OF {columns} ON files BEGIN
+                        INSERT INTO files_fts(files_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+                        INSERT INTO files_fts(rowid, {columns}) VALUES (new.rowid, {new_values});
+                    END
+                """)
+                if created:
+                    # 已有数据的索引库升级时，一次性建立全文索引
+                    self.conn.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"SQLite 不支持 FTS5 trigram，全局搜索退回到逐行匹配: {e}")
+            return False
+    
+    # 读取磁盘信息
+    def _row_from_disk(self, relative_path: str) -> Optional[dict]:
+        full_path = os.path.join(UPLOAD_DIR, relative_path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return None
+        row = {
             "path": relative_path,
-            "size": 0,
-            "created": datetime.fromtimestamp(os.path.getctime(file_path)).strftime("%Y-%m-%d %H:%M:%S"),
-            "uploader_username": "系统",
-            "uploader_ip": "system",
-            "comment": ""
+            "parent": posixpath.dirname(relative_path),
+            "name": posixpath.basename(relative_path),
+            "created": st.st_ctime,
+            "mtime_ns": st.st_mtime_ns,
+            "meta_mtime_ns": None
         }
-    else:
-        # 读取文件元数据
-        metadata = {}
-        metadata_path = file_path + ".meta"
-        if os.path.exists(metadata_path):
-            try:
-                with open(metadata_path, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-            except:
-                pass
+        if os.path.isdir(full_path):
+            row.update({
+                "type": "folder",
+                "size": 0,
+                "uploader_username": "系统",
+                "uploader_ip": "system",
+                "comment": "",
+                "original_name": None,
+                "sha256": None
+            })
+            return row
         
-        return {
-            "name": name,
+        # 从 .meta 导入上传者等信息
+        try:
+            row["meta_mtime_ns"] = os.stat(full_path + ".meta").st_mtime_ns
+        except OSError:
+            pass
+        metadata = read_file_metadata(full_path)
+        row.update({
             "type": "file",
-            "path": relative_path,
-            "size": os.path.getsize(file_path),
-            "created": datetime.fromtimestamp(os.path.getctime(file_path)).strftime("%Y-%m-%d %H:%M:%S"),
+            "size": st.st_size,
             "uploader_username": metadata.get("uploader_username", "未知用户"),
             "uploader_ip": metadata.get("uploader_ip", "未知"),
             "comment": metadata.get("comment", ""),
-            "original_name": metadata.get("original_name", name)
+            "original_name": metadata.get("original_name", row["name"]),
+            "sha256": metadata.get("sha256")
+        })
+        return row
+    
+    # 文件夹汇总：文件夹行的 size 是其下所有文件的总字节数，file_count 是文件数量，
+    # 每次写入或删除文件时把变化量累加到所有上级文件夹
+    def _add_to_ancestors(self, folder: str, size_delta: int, count_delta: int):
+        ancestors = []
+        while folder:
+            ancestors.append(folder)
+            folder = posixpath.dirname(folder)
+        if not ancestors or (size_delta == 0 and count_delta == 0):
+            return
+        self.conn.execute(
+            f"UPDATE files SET size = size + ?, file_count = file_count + ? "
+            f"WHERE path IN ({', '.join('?' for _ in ancestors)})",
+            [size_delta, count_delta] + ancestors
+        )
+    
+    def _subtree_totals(self, relative_path: str):
+        """一个路径下所有文件的总字节数和数量"""
+        size, count = self.conn.execute(
+            "SELECT coalesce(sum(size), 0), count(*) FROM files "
+            "WHERE type = 'file' AND (path = ? OR (path >= ? AND path < ?))",
+            (relative_path, relative_path + "/", relative_path + "0")
+        ).fetchone()
+        return size, count
+    
+    def _write_row(self, row: dict):
+        old = self.conn.execute(
+            "SELECT type, size FROM files WHERE path = ?", (row["path"],)
+        ).fetchone()
+        if old is not None and old["type"] != row["type"]:
+            # 文件被同名文件夹替换（或相反），先删除旧条目
+            self._delete_subtree(row["path"])
+            old = None
+        
+        if row["type"] == "folder":
+            # 文件夹的汇总由子项维护，更新其他信息时保持不变
+            row = dict(row, size=0, file_count=0)
+            keep = ("path", "size", "file_count")
+        else:
+            row = dict(row, file_count=1)
+            keep = ("path",)
+            old_size = old["size"] if old is not None else 0
+            self._add_to_ancestors(row["parent"], row["size"] - old_size, 0 if old is not None else 1)
+        
+        # 使用 UPSERT 而不是 INSERT OR REPLACE，保持 rowid 不变，全文索引触发器才能正确更新
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in self.COLUMNS if c not in keep)
+        self.conn.execute(
+            f"INSERT INTO files ({', '.join(self.COLUMNS)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(path) DO UPDATE SET {updates}",
+            [row[c] for c in self.COLUMNS]
+        )
+    
+    def _ensure_parents(self, folder: str):
+        """确保所有上级文件夹都在索引中"""
+        while folder:
+            if self.conn.execute("SELECT 1 FROM files WHERE path = ?", (folder,)).fetchone():
+                return
+            row = self._row_from_disk(folder)
+            if row is None:
+                return
+            self._write_row(row)
+            folder = row["parent"]
+    
+    def _delete_subtree(self, relative_path: str):
+        size, count = self._subtree_totals(relative_path)
+        self._add_to_ancestors(posixpath.dirname(relative_path), -size, -count)
+        # '/' 的下一个字符是 '0'，用区间查询命中所有子路径并走主键索引
+        self.conn.execute(
+            "DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)",
+            (relative_path, relative_path + "/", relative_path + "0")
+        )
+    
+    # 更新索引
+    def upsert(self, relative_path: str):
+        """按磁盘上的当前状态更新一个路径"""
+        self.upsert_many([relative_path])
+    
+    def upsert_many(self, relative_paths):
+        """在一个事务中更新多个路径"""
+        with self.lock, self.conn:
+            for relative_path in relative_paths:
+                relative_path = normalize_relative_path(relative_path)
+                if not relative_path:
+                    continue
+                row = self._row_from_disk(relative_path)
+                if row is None:
+                    self._delete_subtree(relative_path)
+                    continue
+                self._ensure_parents(row["parent"])
+                self._write_row(row)
+        notify_file_changes(normalize_relative_path(p) for p in relative_paths)
+    
+    def remove(self, relative_path: str):
+        """删除一个路径及其所有子路径"""
+        relative_path = normalize_relative_path(relative_path)
+        with self.lock, self.conn:
+            self._delete_subtree(relative_path)
+        notify_file_changes([relative_path])
+    
+    def move(self, old_path: str, new_path: str):
+        """移动或重命名路径，子路径一并更新"""
+        old_path = normalize_relative_path(old_path)
+        new_path = normalize_relative_path(new_path)
+        old_length = len(old_path)
+        with self.lock:
+            moved = self.conn.execute("SELECT 1 FROM files WHERE path = ?", (old_path,)).fetchone()
+        if moved is None:
+            # 文件监视可能已经按磁盘状态同步了这次移动，直接以磁盘为准
+            if os.path.isdir(os.path.join(UPLOAD_DIR, new_path)):
+                self.reconcile(new_path)
+            else:
+                self.upsert(new_path)
+            return
+        with self.lock, self.conn:
+            self._delete_subtree(new_path)
+            size, count = self._subtree_totals(old_path)
+            self._add_to_ancestors(posixpath.dirname(old_path), -size, -count)
+            self.conn.execute(
+                "UPDATE files SET path = ?, parent = ?, name = ? WHERE path = ?",
+                (new_path, posixpath.dirname(new_path), posixpath.basename(new_path), old_path)
+            )
+            self.conn.execute(
+                """UPDATE files SET path = ? || substr(path, ?), parent = ? || substr(parent, ?)
+                   WHERE path >= ? AND path < ?""",
+                (new_path, old_length + 1, new_path, old_length + 1, old_path + "/", old_path + "0")
+            )
+            self._ensure_parents(posixpath.dirname(new_path))
+            self._add_to_ancestors(posixpath.dirname(new_path), size, count)
+        notify_file_changes([old_path, new_path])
+    
+    # 查询
+    def get(self, relative_path: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM files WHERE path = ?", (normalize_relative_path(relative_path),)
+            ).fetchone()
+    
+    def folder_exists(self, folder: str) -> bool:
+        folder = normalize_relative_path(folder)
+        if not folder:
+            return True
+        row = self.get(folder)
+        return row is not None and row["type"] == "folder"
+    
+    def sort_keys(self, sort_by: str):
+        """返回排序使用的两个键表达式，第二个键保证顺序唯一，可用于游标分页"""
+        if sort_by == "name":
+            # 文件夹排在前面，然后按名称排序（同一文件夹内名称唯一）
+            return "(type != 'folder')", "name"
+        if sort_by == "uploader_ip":
+            return "coalesce(uploader_ip, '')", "path"
+        return self.SORT_COLUMNS.get(sort_by, "name"), "path"
+    
+    def list_folder(
+        self,
+        folder: str,
+        sort_by: str = "name",
+        sort_order: str = "asc",
+        search: str = "",
+        limit: Optional[int] = None,
+        after: Optional[list] = None
+    ):
+        """列出文件夹内容，排序、搜索和分页都在SQLite中完成
+        
+        返回 (文件列表, 符合条件的总数, 下一页的起始排序键)；after 为上一页返回的排序键，
+        没有下一页时排序键为 None
+        """
+        folder = normalize_relative_path(folder)
+        direction = "DESC" if sort_order == "desc" else "ASC"
+        first_key, second_key = self.sort_keys(sort_by)
+        
+        where = "parent = ?"
+        params = [folder]
+        if search:
+            # 在文件名、上传者和备注中搜索
+            where += """ AND (instr(py_lower(name), ?) > 0
+                        OR instr(py_lower(uploader_username), ?) > 0
+                        OR instr(py_lower(comment), ?) > 0)"""
+            params += [search.lower()] * 3
+        
+        page_where, page_params = where, list(params)
+        if after is not None:
+            # 键集分页：从上一页最后一项之后继续，不受翻页期间插入/删除的影响
+            operator = "<" if direction == "DESC" else ">"
+            page_where += f" AND ({first_key}, {second_key}) {operator} (?, ?)"
+            page_params += list(after)
+        
+        sql = (
+            f"SELECT *, {first_key} AS sort_key_1, {second_key} AS sort_key_2 FROM files "
+            f"WHERE {page_where} ORDER BY {first_key} {direction}, {second_key} {direction}"
+        )
+        if limit is not None:
+            # 多取一条用来判断是否还有下一页
+            sql += " LIMIT ?"
+            page_params.append(limit + 1)
+        
+        with self.lock:
+            rows = self.conn.execute(sql, page_params).fetchall()
+            if limit is None and after is None:
+                total = len(rows)
+            else:
+                total = self.conn.execute(f"SELECT COUNT(*) FROM files WHERE {where}", params).fetchone()[0]
+        
+        next_key = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_key = [rows[-1]["sort_key_1"], rows[-1]["sort_key_2"]]
+        return [self.row_to_info(row) for row in rows], total, next_key
+    
+    def search(self, query: str, folder: str = "", limit: int = 50, offset: int = 0):
+        """在整个上传目录中搜索文件名、原始文件名、上传者和备注，按相关度排序
+        
+        返回 (结果列表, 总数)
+        """
+        terms = [t for t in query.lower().split() if t]
+        if not terms:
+            return [], 0
+        
+        where = ["1"]
+        params = []
+        folder = normalize_relative_path(folder)
+        if folder:
+            where.append("files.path >= ? AND files.path < ?")
+            params += [folder + "/", folder + "0"]
+        
+        # trigram 索引只能匹配3个字符及以上的词，更短的词逐行匹配
+        fts_terms = [t for t in terms if self.fts_enabled and len(t) >= 3]
+        for term in terms:
+            if term in fts_terms:
+                continue
+            where.append("(" + " OR ".join(
+                f"instr(py_lower(files.{c}), ?) > 0" for c in self.SEARCH_COLUMNS
+            ) + ")")
+            params += [term] * len(self.SEARCH_COLUMNS)
+        
+        if fts_terms:
+            match = " AND ".join('"' + t.replace('"', '""') + '"' for t in fts_terms)
+            base = "FROM files_fts JOIN files ON files.rowid = files_fts.rowid WHERE files_fts MATCH ? AND "
+            base_params = [match] + params
+            # 文件名命中权重最高，其次是原始文件名、上传者、备注
+            order_by = "bm25(files_fts, 10.0, 8.0, 2.0, 1.0), files.created DESC"
+        else:
+            base = "FROM files WHERE "
+            base_params = params
+            order_by = "files.created DESC"
+        base += " AND ".join(where)
+        
+        with self.lock:
+            total = self.conn.execute(f"SELECT COUNT(*) {base}", base_params).fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT files.* {base} ORDER BY {order_by} LIMIT ? OFFSET ?",
+                base_params + [limit, offset]
+            ).fetchall()
+        
+        results = []
+        for row in rows:
+            info = self.row_to_info(row)
+            info["folder"] = row["parent"]
+            results.append(info)
+        return results, total
+    
+    @staticmethod
+    def row_to_info(row: sqlite3.Row) -> dict:
+        """转换为 /files 接口返回的文件信息格式"""
+        info = {
+            "name": row["name"],
+            "type": row["type"],
+            "path": row["path"],
+            "size": row["size"],
+            "created": format_timestamp(row["created"]),
+            "uploader_username": row["uploader_username"],
+            "uploader_ip": row["uploader_ip"],
+            "comment": row["comment"]
         }
+        if row["type"] == "file":
+            info["original_name"] = row["original_name"]
+            info["sha256"] = row["sha256"]
+        else:
+            # 文件夹的 size 是其下所有文件的总大小
+            info["file_count"] = row["file_count"]
+        return info
+    
+    # 与磁盘同步
+    def reconcile(self, folder: str = "") -> dict:
+        """扫描UPLOAD_DIR（或其中一个文件夹），导入新增或变化的条目，删除已不存在的条目"""
+        folder = normalize_relative_path(folder)
+        root = os.path.join(UPLOAD_DIR, folder) if folder else UPLOAD_DIR
+        with self.lock:
+            # 文件夹的 size 是汇总值，不参与比较
+            sql = ("SELECT path, mtime_ns, meta_mtime_ns, "
+                   "CASE WHEN type = 'folder' THEN 0 ELSE size END AS size, type FROM files")
+            params = ()
+            if folder:
+                sql += " WHERE path = ? OR (path >= ? AND path < ?)"
+                params = (folder, folder + "/", folder + "0")
+            known = {
+                row["path"]: (row["mtime_ns"], row["meta_mtime_ns"], row["size"], row["type"])
+                for row in self.conn.execute(sql, params)
+            }
+        
+        candidates = []
+        if folder and os.path.isdir(root):
+            candidates.append(root)
+        for current_dir, dir_names, file_names in os.walk(root):
+            dir_names[:] = [d for d in dir_names if not is_hidden_entry(d)]
+            for name in dir_names + [f for f in file_names if not is_hidden_entry(f)]:
+                candidates.append(os.path.join(current_dir, name))
+        
+        seen = set()
+        changed = []
+        for full_path in candidates:
+            relative_path = to_relative_path(full_path)
+            seen.add(relative_path)
+            try:
+                st = os.stat(full_path)
+                meta_mtime_ns = None
+                if os.path.exists(full_path + ".meta"):
+                    meta_mtime_ns = os.stat(full_path + ".meta").st_mtime_ns
+            except OSError:
+                continue
+            is_dir = os.path.isdir(full_path)
+            current = (
+                st.st_mtime_ns,
+                None if is_dir else meta_mtime_ns,
+                0 if is_dir else st.st_size,
+                "folder" if is_dir else "file"
+            )
+            if known.get(relative_path) != current:
+                changed.append(relative_path)
+        
+        removed = [path for path in known if path not in seen]
+        with self.lock, self.conn:
+            for relative_path in removed:
+                self._delete_subtree(relative_path)
+        notify_file_changes(removed)
+        # 按路径排序，保证上级文件夹先于子路径写入
+        self.upsert_many(sorted(changed))
+        return {
+            "changed": len(changed),
+            "removed": len(removed),
+            "total": len(seen),
+            "paths": changed + removed
+        }
+
+file_index = FileIndex(FILE_INDEX_DB)
+
+# 文件系统监视：UPLOAD_DIR 中的文件也可能从外部写入（例如 docker-compose 中共享的目录），
+# 用 inotify 监听变化并增量更新索引；不支持 inotify 时退回到定期扫描对账
+FILE_WATCH_DEBOUNCE = 0.2  # 合并短时间内的连续变化（秒）
+FILE_WATCH_RECONCILE_INTERVAL = int(os.environ.get("FILE_WATCH_RECONCILE_INTERVAL", "600"))
+FILE_WATCH_FALLBACK_INTERVAL = 30  # 没有 inotify 时的扫描间隔（秒）
+
+# 文件变化监听者：接收发生变化的相对路径集合，用于让缓存失效。
+# FileIndex 的每次写入（应用自身的操作、监视到的外部变化、对账）都会通知监听者，
+# 监听者可能在工作线程中被调用
+file_change_listeners: List = []
+_deferred_file_changes = threading.local()
+
+@contextlib.contextmanager
+def defer_file_change_notifications():
+    """在当前线程中收集变化，结束时一次性通知（批量操作只让缓存失效一次）"""
+    _deferred_file_changes.paths = set()
+    try:
+        yield
+    finally:
+        paths, _deferred_file_changes.paths = _deferred_file_changes.paths, None
+        notify_file_changes(paths)
+
+def notify_file_changes(paths):
+    """通知所有监听者这些路径发生了变化"""
+    paths = set(paths)
+    if not paths:
+        return
+    deferred = getattr(_deferred_file_changes, "paths", None)
+    if deferred is not None:
+        deferred.update(paths)
+        return
+    for listener in file_change_listeners:
+        try:
+            listener(paths)
+        except Exception as e:
+            print(f"文件变化监听者处理失败: {e}")
+
+class InotifyWatcher:
+    """基于 ctypes 的 Linux inotify 递归监视"""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                  | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, on_change):
+        """on_change(relative_path, rescan) 在事件循环线程中被调用"""
+        self.on_change = on_change
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.watches: Dict[int, str] = {}  # wd -> 相对路径
+        self.paths: Dict[str, int] = {}  # 相对路径 -> wd
+        self.overflowed = False
+        self.tree_tasks: set = set()  # 正在扫描的新文件夹
+    
+    @staticmethod
+    def list_tree(relative_path: str) -> List[str]:
+        """文件夹及其所有子文件夹的相对路径（遍历磁盘，在I/O线程中调用）"""
+        root = os.path.join(UPLOAD_DIR, relative_path) if relative_path else UPLOAD_DIR
+        paths = []
+        for current_dir, dir_names, _ in os.walk(root):
+            dir_names[:] = [d for d in dir_names if not is_hidden_entry(d)]
+            paths.append(to_relative_path(current_dir))
+        return paths
+    
+    def add_tree(self, relative_path: str):
+        """监视一个文件夹及其所有子文件夹"""
+        for path in self.list_tree(relative_path):
+            self._add_watch(path)
+    
+    async def _add_tree_async(self, relative_path: str):
+        """新文件夹：在I/O线程中遍历子树，回到事件循环添加监视后再整体扫描"""
+        try:
+            paths = await run_io(self.list_tree, relative_path)
+        except OSError:
+            paths = []
+        for path in paths:
+            self._add_watch(path)
+        self.on_change(relative_path, True)
+    
+    def _add_watch(self, relative_path: str):
+        full_path = os.path.join(UPLOAD_DIR, relative_path) if relative_path else UPLOAD_DIR
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(full_path), self.WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if not self.overflowed:
+                # 通常是 fs.inotify.max_user_watches 不够，剩下的交给定期对账
+                print(f"无法监视 {full_path}: {os.strerror(error)}")
+                self.overflowed = True
+            return
+        self.watches[wd] = relative_path
+        self.paths[relative_path] = wd
+    
+    def remove_tree(self, relative_path: str):
+        """停止监视一个文件夹及其子文件夹（文件夹被移走时）"""
+        prefix = relative_path + "/"
+        for path in [p for p in self.paths if p == relative_path or p.startswith(prefix)]:
+            wd = self.paths.pop(path)
+            self.watches.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+    
+    def read_events(self):
+        """读取并处理所有待处理的事件（由事件循环在 fd 可读时调用）"""
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                self._handle_event(wd, mask, name)
+    
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & self.IN_Q_OVERFLOW:
+            # 事件队列溢出，丢失了变化，整体重新扫描
+            self.on_change("", True)
+            return
+        if mask & self.IN_IGNORED:
+            relative_path = self.watches.pop(wd, None)
+            if relative_path is not None and self.paths.get(relative_path) == wd:
+                del self.paths[relative_path]
+            return
+        folder = self.watches.get(wd)
+        if folder is None or mask & self.IN_DELETE_SELF:
+            return
+        if not name or (is_hidden_entry(name) and not name.endswith(".meta")):
+            return
+        
+        # .meta 变化对应的是它所描述的文件
+        if name.endswith(".meta"):
+            name = name[:-len(".meta")]
+        relative_path = posixpath.join(folder, name) if folder else name
+        is_dir = bool(mask & self.IN_ISDIR)
+        
+        if is_dir and mask & self.IN_MOVED_FROM:
+            self.remove_tree(relative_path)
+        if is_dir and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            # 新文件夹在添加监视之前可能已经有内容写入，添加监视后需要扫描整个子树
+            task = asyncio.get_running_loop().create_task(self._add_tree_async(relative_path))
+            self.tree_tasks.add(task)
+            task.add_done_callback(self.tree_tasks.discard)
+            return
+        self.on_change(relative_path, False)
+    
+    def close(self):
+        for task in self.tree_tasks:
+            task.cancel()
+        os.close(self.fd)
 
-# 挂载静态文件目录
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+class FileWatcher:
+    """把文件系统变化汇总为变化流，增量更新索引并通知缓存"""
+    def __init__(self):
+        self.inotify: Optional[InotifyWatcher] = None
+        self.pending: Dict[str, bool] = {}  # 相对路径 -> 是否需要扫描子树
+        self.wakeup = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+    
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.inotify = InotifyWatcher(self.queue_change)
+            await run_io(self.inotify.add_tree, "")
+            loop.add_reader(self.inotify.fd, self.inotify.read_events)
+            print(f"文件监视已启动: 监视 {len(self.inotify.watches)} 个文件夹")
+            interval = FILE_WATCH_RECONCILE_INTERVAL
+        except (OSError, AttributeError) as e:
+            print(f"inotify 不可用，使用定期扫描: {e}")
+            self.inotify = None
+            interval = FILE_WATCH_FALLBACK_INTERVAL
+        self.tasks = [
+            asyncio.create_task(self._apply_changes()),
+            asyncio.create_task(self._periodic_reconcile(interval))
+        ]
+    
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.inotify is not None:
+            asyncio.get_running_loop().remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+    
+    def queue_change(self, relative_path: str, rescan: bool):
+        self.pending[relative_path] = self.pending.get(relative_path, False) or rescan
+        self.wakeup.set()
+    
+    async def _apply_changes(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(FILE_WATCH_DEBOUNCE)
+            self.wakeup.clear()
+            changes, self.pending = self.pending, {}
+            try:
+                await run_io(self._sync_index, changes)
+            except Exception as e:
+                print(f"应用文件变化失败: {e}")
+    
+    @staticmethod
+    def _sync_index(changes: Dict[str, bool]):
+        """按磁盘当前状态同步发生变化的路径（索引写入时会通知监听者）"""
+        rescan_roots = sorted(path for path, rescan in changes.items() if rescan)
+        if "" in rescan_roots:
+            rescan_roots = [""]
+        for root in rescan_roots:
+            file_index.reconcile(root)
+        
+        paths = [
+            path for path in changes
+            if not any(root == "" or path == root or path.startswith(root + "/") for root in rescan_roots)
+        ]
+        # upsert 会按磁盘状态写入，已不存在的路径会被删除
+        file_index.upsert_many(sorted(paths))
+    
+    async def _periodic_reconcile(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stats = await run_io(file_index.reconcile)
+                if stats["paths"]:
+                    print(f"定期对账: 更新 {stats['changed']} 项, 删除 {stats['removed']} 项")
+            except Exception as e:
+                print(f"定期对账失败: {e}")
+
+file_watcher = FileWatcher()
+
+# 挂载静态文件目录（/uploads 由下面支持Range的路由提供）
 app.mount("/image", StaticFiles(directory="image"), name="image")
 
 # 用户管理
@@ -198,67 +1132,391 @@ user_sessions: Dict[str, str] = {}  # username -> session_id
 chat_history: List[ChatMessage] = []  # 全局聊天历史
 private_chat_history: Dict[str, List[ChatMessage]] = defaultdict(list)  # 私聊历史
 
-# 添加全局聊天历史存储
-global_chat_history: List[dict] = []
-private_chat_storage: Dict[str, List[dict]] = defaultdict(list)  # IP对话历史
+# 聊天消息存储：所有消息保存在 SQLite(WAL模式) 中，按 (会话, 时间) 和参与者建立索引。
+# 内存中每个会话只保留最近 MAX_HISTORY_MESSAGES 条，用于给新连接推送历史；
+# 私聊最多保留 CHAT_HOT_CONVERSATIONS 个最近使用的会话，其余按需从数据库加载；
+# 更早的消息通过 /chat/history 按需查询，服务运行再久内存也不会增长
 MAX_HISTORY_MESSAGES = 200  # 增加历史消息数量
+CHAT_HOT_CONVERSATIONS = int(os.environ.get("CHAT_HOT_CONVERSATIONS", "1000"))
+global_chat_history: deque = deque(maxlen=MAX_HISTORY_MESSAGES)
+private_chat_participants: Dict[str, set] = defaultdict(set)  # IP -> 参与的私聊会话键，写入消息时维护
+GROUP_CONVERSATION = "group"  # 群聊的会话键；私聊的会话键是排序后的两个IP用 _ 连接
+CHAT_DB = os.path.join("database", "chat_store.db")  # 独立文件，不与旧版本的 chat.db 混用
 
-# 历史消息文件路径
+# 旧版本的历史文件，首次启动时一次性导入数据库
 GROUP_HISTORY_FILE = os.path.join(CHAT_HISTORY_DIR, "group_history.json")
 PRIVATE_HISTORY_FILE = os.path.join(CHAT_HISTORY_DIR, "private_history.json")
+LEGACY_CHAT_LOG_FILE = os.path.join(CHAT_HISTORY_DIR, "chat_log.jsonl")
+LEGACY_CHAT_SNAPSHOT_FILE = os.path.join(CHAT_HISTORY_DIR, "chat_snapshot.json")
 
-# 启动时加载历史消息
-async def load_chat_history():
-    """从文件加载聊天历史"""
-    global global_chat_history, private_chat_storage
-    
-    # 加载群聊历史
+# 分组提交：消息先进入待写队列，由一个写入任务在一个事务中批量写入，
+# 第一条消息到达后最多等待 CHAT_LOG_FLUSH_MS 毫秒，或凑满 CHAT_LOG_FLUSH_RECORDS 条立即写入
+CHAT_LOG_FLUSH_INTERVAL = int(os.environ.get("CHAT_LOG_FLUSH_MS", "50")) / 1000
+CHAT_LOG_FLUSH_RECORDS = int(os.environ.get("CHAT_LOG_FLUSH_RECORDS", "256"))
+# fsync 策略，对应 SQLite 的 synchronous：always 每次提交都 fsync；
+# everysec 只在WAL检查点时 fsync（断电可能丢失最近的提交）；no 交给操作系统
+CHAT_LOG_FSYNC = os.environ.get("CHAT_LOG_FSYNC", "everysec")
+CHAT_SYNCHRONOUS = {"always": "FULL", "everysec": "NORMAL", "no": "OFF"}
+
+def private_chat_key(ip1: str, ip2: str) -> str:
+    """私聊的会话键（按字典序排序确保一致性）"""
+    return "_".join(sorted([ip1, ip2]))
+
+def message_timestamp(message: dict) -> float:
     try:
-        if os.path.exists(GROUP_HISTORY_FILE):
-            async with aiofiles.open(GROUP_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                content = await f.read()
+        return float(message.get("timestamp") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def read_legacy_chat_history():
+    """读取旧版本的历史：JSONL日志+快照，或更早的整体JSON文件，返回 (群聊消息, 私聊会话)"""
+    snapshot = {"seq": 0, "group_history": [], "private_history": {}}
+    if os.path.exists(LEGACY_CHAT_SNAPSHOT_FILE):
+        with open(LEGACY_CHAT_SNAPSHOT_FILE, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    else:
+        for path, field in ((GROUP_HISTORY_FILE, "group_history"), (PRIVATE_HISTORY_FILE, "private_history")):
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    content = f.read()
                 if content.strip():
-                    global_chat_history = json.loads(content)
-                    print(f"加载群聊历史消息: {len(global_chat_history)} 条")
-    except Exception as e:
-        print(f"加载群聊历史失败: {e}")
-        global_chat_history = []
+                    snapshot[field] = json.loads(content)
+    group_history = list(snapshot["group_history"])
+    private_history = defaultdict(list, snapshot["private_history"])
     
-    # 加载私聊历史
-    try:
-        if os.path.exists(PRIVATE_HISTORY_FILE):
-            async with aiofiles.open(PRIVATE_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                if content.strip():
-                    private_chat_storage = defaultdict(list, json.loads(content))
-                    print(f"加载私聊历史: {len(private_chat_storage)} 个对话")
-    except Exception as e:
-        print(f"加载私聊历史失败: {e}")
-        private_chat_storage = defaultdict(list)
+    records = []
+    for path in legacy_chat_log_paths():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    records.sort(key=lambda record: record.get("seq", 0))
+    for record in records:
+        if record.get("seq", 0) <= snapshot["seq"]:
+            continue
+        op = record.get("op")
+        if op == "group":
+            group_history.append(record["message"])
+        elif op == "private":
+            private_history[record["key"]].append(record["message"])
+        elif op == "clear":
+            group_history.clear()
+            private_history.clear()
+    return group_history, private_history
 
-async def save_group_history():
-    """保存群聊历史到文件"""
-    try:
-        # 保留最新的消息
-        messages_to_save = global_chat_history[-MAX_HISTORY_MESSAGES:] if len(global_chat_history) > MAX_HISTORY_MESSAGES else global_chat_history
-        
-        async with aiofiles.open(GROUP_HISTORY_FILE, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(messages_to_save, ensure_ascii=False, indent=2))
-    except Exception as e:
-        print(f"保存群聊历史失败: {e}")
+def legacy_chat_log_paths() -> List[str]:
+    base, ext = os.path.splitext(os.path.basename(LEGACY_CHAT_LOG_FILE))
+    return sorted(
+        os.path.join(CHAT_HISTORY_DIR, name) for name in os.listdir(CHAT_HISTORY_DIR)
+        if name.startswith(base) and name.endswith(ext)
+    )
 
-async def save_private_history():
-    """保存私聊历史到文件"""
-    try:
-        # 清理过老的私聊记录，保留每个对话的最新消息
-        cleaned_storage = {}
-        for chat_key, messages in private_chat_storage.items():
-            cleaned_storage[chat_key] = messages[-MAX_HISTORY_MESSAGES:] if len(messages) > MAX_HISTORY_MESSAGES else messages
+class ChatStore:
+    """聊天消息的 SQLite 存储，写入由一个任务分组提交"""
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.seq = 0  # 最后分配的消息序号，单调递增，客户端重连时据此只获取增量
+        self.cleared_seq = 0  # 最近一次清空历史时的序号，客户端在此之前的本地历史已失效
+        self.pending: List[tuple] = []  # 等待写入的操作: ("insert", 行, 参与者) 或 ("clear", 清空时的序号)
+        self.wakeup = asyncio.Event()  # 有待写入的操作
+        self.batch_full = asyncio.Event()  # 待写入的操作已凑满一批
+        self.write_lock = asyncio.Lock()
+        self.writer_task: Optional[asyncio.Task] = None
+        self.closing = False
+    
+    def open(self) -> int:
+        """打开数据库（在I/O线程中调用），首次启动时导入旧版本的历史，返回导入的消息数"""
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f"PRAGMA synchronous={CHAT_SYNCHRONOUS.get(CHAT_LOG_FSYNC, 'NORMAL')}")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    seq INTEGER PRIMARY KEY,
+                    conversation TEXT NOT NULL,
+                    timestamp REAL NOT NULL,
+                    ip TEXT,
+                    message TEXT NOT NULL
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation, timestamp)"
+            )
+            # 参与者索引：按IP查找其所在的私聊会话
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS participants (
+                    ip TEXT NOT NULL,
+                    conversation TEXT NOT NULL,
+                    PRIMARY KEY (ip, conversation)
+                )
+            """)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
         
-        async with aiofiles.open(PRIVATE_HISTORY_FILE, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(cleaned_storage, ensure_ascii=False, indent=2))
-    except Exception as e:
-        print(f"保存私聊历史失败: {e}")
+        imported = 0
+        if self._get_meta("legacy_imported") is None:
+            imported = self._import_legacy()
+        with self.lock:
+            max_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages").fetchone()[0]
+        # 清空历史后序号也不回退
+        self.seq = max(max_seq, int(self._get_meta("last_seq") or 0))
+        self.cleared_seq = int(self._get_meta("cleared_seq") or 0)
+        return imported
+    
+    def _get_meta(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row is not None else None
+    
+    def _import_legacy(self) -> int:
+        try:
+            group_history, private_history = read_legacy_chat_history()
+        except Exception as e:
+            # 不标记已导入、不删除任何文件，下次启动时重试
+            print(f"读取旧版本聊天历史失败，下次启动时重试: {e}")
+            return 0
+        operations = [("insert", self._row(GROUP_CONVERSATION, message), ()) for message in group_history]
+        for chat_key, messages in private_history.items():
+            participants = tuple(chat_key.split("_")) if chat_key.count("_") == 1 else ()
+            operations.extend(("insert", self._row(chat_key, message), participants) for message in messages)
+        with self.lock, self.conn:
+            self._apply(operations)
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)", (str(time.time()),))
+        # JSONL日志和快照只是上一版本的运行时文件，导入的事务提交后再删除
+        for path in legacy_chat_log_paths():
+            os.remove(path)
+        remove_if_exists(LEGACY_CHAT_SNAPSHOT_FILE)
+        return len(operations)
+    
+    def _row(self, conversation: str, message: dict) -> tuple:
+        self.seq += 1
+        message["seq"] = self.seq
+        return (self.seq, conversation, message_timestamp(message), message.get("ip"), json.dumps(message, ensure_ascii=False))
+    
+    def load_recent(self):
+        """群聊最近的 MAX_HISTORY_MESSAGES 条消息和私聊参与关系，返回 (群聊消息, [(IP, 私聊键)])；
+        私聊消息在用到时再加载"""
+        with self.lock:
+            participants = [(row["ip"], row["conversation"]) for row in self.conn.execute("SELECT ip, conversation FROM participants")]
+        group_history = self.query(GROUP_CONVERSATION, limit=MAX_HISTORY_MESSAGES)
+        return group_history, participants
+    
+    def query(self, conversation: str, before: Optional[float] = None, limit: int = 50,
+              before_seq: Optional[int] = None) -> List[dict]:
+        """会话中 before 之前（不指定则为最新）的 limit 条消息，按时间顺序返回
+        
+        同时指定 before_seq 时按 (时间, 序号) 键集分页，时间戳相同的消息不会被跳过
+        """
+        sql = "SELECT seq, message FROM messages WHERE conversation = ?"
+        params = [conversation]
+        if before is not None and before_seq is not None:
+            sql += " AND (timestamp, seq) < (?, ?)"
+            params.extend([before, before_seq])
+        elif before is not None:
+            sql += " AND timestamp < ?"
+            params.append(before)
+        sql += " ORDER BY timestamp DESC, seq DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        messages = []
+        for row in reversed(rows):
+            message = json.loads(row["message"])
+            message.setdefault("seq", row["seq"])
+            messages.append(message)
+        return messages
+    
+    def conversations_for(self, ip: str) -> List[dict]:
+        """IP参与的私聊会话，最近有消息的在前"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT p.conversation,
+                       (SELECT MAX(timestamp) FROM messages m WHERE m.conversation = p.conversation) AS last_timestamp
+                FROM participants p WHERE p.ip = ?
+                ORDER BY last_timestamp DESC
+            """, (ip,)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def add_message(self, conversation: str, message: dict, participants: tuple = ()):
+        """分配序号并放入待写队列，由写入任务分组提交"""
+        self._enqueue(("insert", self._row(conversation, message), participants))
+    
+    def clear(self):
+        self.cleared_seq = self.seq
+        self._enqueue(("clear", self.cleared_seq))
+    
+    def _enqueue(self, operation: tuple):
+        self.pending.append(operation)
+        self.wakeup.set()
+        if len(self.pending) >= CHAT_LOG_FLUSH_RECORDS:
+            self.batch_full.set()
+    
+    def _apply(self, operations: List[tuple]):
+        """在当前事务中执行写入操作（调用者持有锁）"""
+        for operation in operations:
+            if operation[0] == "clear":
+                self.conn.execute("DELETE FROM messages")
+                self.conn.execute("DELETE FROM participants")
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_seq', ?)", (str(self.seq),))
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('cleared_seq', ?)", (str(operation[1]),))
+                continue
+            _, row, participants = operation
+            self.conn.execute("INSERT INTO messages (seq, conversation, timestamp, ip, message) VALUES (?, ?, ?, ?, ?)", row)
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO participants (ip, conversation) VALUES (?, ?)",
+                [(ip, row[1]) for ip in participants]
+            )
+    
+    def _write_batch(self, operations: List[tuple]):
+        with self.lock, self.conn:
+            self._apply(operations)
+    
+    def start(self):
+        """启动写入任务（open 之后在事件循环中调用）"""
+        self.closing = False
+        self.writer_task = asyncio.create_task(self._writer())
+    
+    async def _writer(self):
+        while not self.closing:
+            await self.wakeup.wait()
+            if len(self.pending) < CHAT_LOG_FLUSH_RECORDS and not self.closing:
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), CHAT_LOG_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"写入聊天记录失败: {e}")
+                await asyncio.sleep(1)
+    
+    async def flush(self):
+        """把待写队列中的操作在一个事务中提交"""
+        async with self.write_lock:
+            if not self.pending:
+                return
+            operations, self.pending = self.pending, []
+            self.wakeup.clear()
+            self.batch_full.clear()
+            try:
+                await run_io(self._write_batch, operations)
+            except Exception:
+                # 写入失败时放回队列并唤醒写入任务，下次重试（否则要等到有新消息才会重试）
+                self.pending[:0] = operations
+                self.wakeup.set()
+                raise
+    
+    async def close(self):
+        """停止写入任务并提交剩余的消息"""
+        if self.writer_task is not None:
+            self.closing = True
+            self.wakeup.set()
+            self.batch_full.set()
+            await self.writer_task
+            self.writer_task = None
+        await self.flush()
+        with self.lock:
+            self.conn.close()
+
+chat_store = ChatStore(CHAT_DB)
+
+class HotConversations:
+    """私聊会话最近消息的 LRU，内存中最多 capacity 个会话；被淘汰的会话用到时再从数据库加载"""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: "OrderedDict[str, deque]" = OrderedDict()  # 私聊键 -> 最近的消息
+        self.loading: Dict[str, List[dict]] = {}  # 正在加载的会话 -> 加载期间新增的消息
+        self.load_tasks: Dict[str, asyncio.Task] = {}
+        self.generation = 0  # 每次清空加一，防止把清空前加载的结果放回内存
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def append(self, chat_key: str, message: dict, known: bool):
+        """记录新消息；known 为 False 表示数据库中还没有这个会话"""
+        messages = self.entries.get(chat_key)
+        if messages is not None:
+            messages.append(message)
+            self.entries.move_to_end(chat_key)
+        elif chat_key in self.loading:
+            self.loading[chat_key].append(message)
+        elif not known:
+            self._put(chat_key, deque([message], maxlen=MAX_HISTORY_MESSAGES))
+        # 已被淘汰的会话只写数据库，下次用到时加载
+    
+    async def load(self, chat_key: str) -> deque:
+        """会话最近的消息，不在内存中时从数据库加载（同一会话并发加载只查询一次）"""
+        messages = self.entries.get(chat_key)
+        if messages is not None:
+            self.entries.move_to_end(chat_key)
+            return messages
+        task = self.load_tasks.get(chat_key)
+        if task is None:
+            task = self.load_tasks[chat_key] = asyncio.create_task(self._load(chat_key))
+        return await asyncio.shield(task)
+    
+    async def _load(self, chat_key: str) -> deque:
+        generation = self.generation
+        self.loading[chat_key] = []
+        try:
+            # 先提交待写入的消息，保证查询结果完整
+            await chat_store.flush()
+            loaded = await run_io(chat_store.query, chat_key, None, MAX_HISTORY_MESSAGES)
+            messages = deque(loaded, maxlen=MAX_HISTORY_MESSAGES)
+            # 加载期间新增的消息可能已经在查询结果中，按序号去重
+            seen = {message.get("seq") for message in loaded}
+            messages.extend(m for m in self.loading.get(chat_key, ()) if m.get("seq") not in seen)
+            if generation == self.generation:
+                self._put(chat_key, messages)
+            return messages
+        finally:
+            self.loading.pop(chat_key, None)
+            self.load_tasks.pop(chat_key, None)
+    
+    def _put(self, chat_key: str, messages: deque):
+        self.entries[chat_key] = messages
+        self.entries.move_to_end(chat_key)
+        while len(self.entries) > self.capacity:
+            evicted, _ = self.entries.popitem(last=False)
+            history_frame_cache.pop(evicted, None)
+    
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        for pending in self.loading.values():
+            pending.clear()
+
+private_chat_storage = HotConversations(CHAT_HOT_CONVERSATIONS)  # IP对话历史
+
+# 启动时加载历史消息
+async def load_chat_history():
+    """打开聊天数据库，加载群聊最近的消息和私聊参与关系"""
+    imported = await run_io(chat_store.open)
+    if imported:
+        print(f"导入旧版本聊天历史: {imported} 条")
+    group_history, participants = await run_io(chat_store.load_recent)
+    global_chat_history.clear()
+    global_chat_history.extend(group_history)
+    private_chat_storage.clear()
+    private_chat_participants.clear()
+    for ip, chat_key in participants:
+        private_chat_participants[ip].add(chat_key)
+    chat_store.start()
+    print(f"加载群聊历史消息: {len(global_chat_history)} 条")
+    print(f"私聊会话: {len({chat_key for _, chat_key in participants})} 个（按需加载）")
+
+async def clear_chat_history():
+    """清空所有群聊和私聊历史"""
+    global_chat_history.clear()
+    private_chat_storage.clear()
+    private_chat_participants.clear()
+    history_frame_cache.clear()
+    chat_store.clear()
+    await chat_store.flush()
 
 # 优化的IP获取函数 - 保持不变
 def get_real_client_ip(request: Request = None, websocket: WebSocket = None) -> str:
@@ -304,140 +1562,311 @@ def get_real_client_ip(request: Request = None, websocket: WebSocket = None) ->
     # 最后的备选方案
     return client_host or "unknown"
 
+# WebSocket 发送队列：每个连接一个有界队列和一个写入任务，广播只把消息放入队列，
+# 一个网络很差的客户端不会拖慢其他人。只有带合并键的状态帧（如任务进度）可以丢弃，
+# 聊天消息带有序号，丢弃后客户端按序号增量同步也无法补齐。队列满时按 WS_SLOW_CONSUMER_POLICY 处理：
+# drop_oldest 丢弃最旧的状态帧；coalesce 同一合并键只保留最新一条，仍满时丢弃最旧的状态帧；
+# disconnect 直接断开。没有可丢弃的帧时都会断开该连接，客户端重连时带上序号补齐缺失的消息
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "256"))
+WS_SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "disconnect")
+WS_SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+WS_CLOSE_TIMEOUT = 5  # 断开慢连接时等待关闭握手的秒数
+
+def encode_ws_message(message: dict) -> str:
+    """序列化为 WebSocket 文本帧（与 send_json 相同的格式），广播时只序列化一次"""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+class WebSocketOutbox:
+    """单个连接的有界发送队列，由该连接自己的写入任务按顺序发送（在连接的处理任务中创建）"""
+    
+    def __init__(self, websocket: WebSocket, name: str, on_close=None):
+        self.websocket = websocket
+        self.name = name
+        self.on_close = on_close
+        self.policy = WS_SLOW_CONSUMER_POLICY if WS_SLOW_CONSUMER_POLICY in WS_SLOW_CONSUMER_POLICIES else "drop_oldest"
+        self.queue: deque = deque()  # (文本帧, 合并键)
+        self.wakeup = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+        self.handler_task = asyncio.current_task()  # 该连接的处理任务，断开慢连接时取消
+        self.close_task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.dropped = 0
+    
+    def start(self):
+        """启动写入任务；之前放入队列的消息按顺序发出"""
+        if self.writer_task is None and not self.closed:
+            self.writer_task = asyncio.create_task(self._writer())
+    
+    def send_json(self, message: dict, coalesce_key: Optional[str] = None) -> bool:
+        return self.send_text(encode_ws_message(message), coalesce_key)
+    
+    def send_text(self, frame: str, coalesce_key: Optional[str] = None) -> bool:
+        """放入发送队列，不等待发送；连接已关闭（或因太慢被断开）时返回 False"""
+        if self.closed:
+            return False
+        if coalesce_key is not None and self.policy == "coalesce":
+            for i, (_, key) in enumerate(self.queue):
+                if key == coalesce_key:
+                    self.queue[i] = (frame, coalesce_key)
+                    return True
+        if len(self.queue) >= WS_SEND_QUEUE_SIZE:
+            droppable = next((i for i, (_, key) in enumerate(self.queue) if key is not None), None)
+            if self.policy == "disconnect" or (droppable is None and coalesce_key is None):
+                print(f"连接 {self.name} 发送队列已满 ({len(self.queue)} 条)，断开慢连接")
+                self.abort()
+                return False
+            self.dropped += 1
+            if self.dropped == 1:
+                print(f"连接 {self.name} 发送队列已满，开始丢弃状态帧")
+            if droppable is None:
+                # 队列里都是聊天消息，丢弃这一条新的状态帧
+                return True
+            del self.queue[droppable]
+        self.queue.append((frame, coalesce_key))
+        self.wakeup.set()
+        return True
+    
+    async def _writer(self):
+        try:
+            while True:
+                while not self.queue and not self.closed:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                if self.closed:
+                    return
+                frame, _ = self.queue.popleft()
+                await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending message to {self.name}: {e}")
+            self.close()
+    
+    def close(self):
+        """停止发送并丢弃未发送的消息（可重复调用）"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.wakeup.set()
+        if self.dropped:
+            print(f"连接 {self.name} 共丢弃 {self.dropped} 条状态帧")
+        if self.on_close is not None:
+            self.on_close()
+    
+    def abort(self):
+        """断开慢连接：取消卡住的发送，关闭 WebSocket 并结束它的接收循环"""
+        if self.close_task is not None:
+            return
+        self.close()
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+        self.close_task = asyncio.create_task(self._close_websocket())
+    
+    async def _close_websocket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1013, reason="send queue full"), WS_CLOSE_TIMEOUT)
+        except Exception:
+            pass
+        finally:
+            # 卡住的客户端可能不回应关闭握手，直接结束处理任务，由服务器关闭底层连接
+            if self.handler_task is not None and not self.handler_task.done():
+                self.handler_task.cancel()
+
 # 修改 WebSocket 连接管理，使用用户名
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}  # session_id -> WebSocket
+        self.outboxes: Dict[str, WebSocketOutbox] = {}  # session_id -> 发送队列
 
     async def connect(self, websocket: WebSocket, session_id: str):
         await websocket.accept()
         self.active_connections[session_id] = websocket
+        outbox = self.outboxes[session_id] = WebSocketOutbox(websocket, session_id, on_close=lambda: self.disconnect(session_id))
+        outbox.start()
         print(f"User connected with session: {session_id}")
 
     def disconnect(self, session_id: str):
+        outbox = self.outboxes.pop(session_id, None)
+        if outbox is not None:
+            outbox.close()
         if session_id in self.active_connections:
             del self.active_connections[session_id]
             print(f"User disconnected: {session_id}")
 
     async def broadcast(self, message: dict, exclude_session: str = None):
-        disconnected_sessions = []
-        
-        for session_id, connection in self.active_connections.items():
+        frame = encode_ws_message(message)
+        for session_id, outbox in list(self.outboxes.items()):
             if session_id != exclude_session:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    print(f"Error sending message to {session_id}: {e}")
-                    disconnected_sessions.append(session_id)
-        
-        # 清理断开的连接
-        for session_id in disconnected_sessions:
-            self.disconnect(session_id)
+                outbox.send_text(frame)
 
     async def send_private_message(self, message: dict, target_session: str, sender_session: str):
-        try:
-            # 发送给目标用户
-            if target_session in self.active_connections:
-                await self.active_connections[target_session].send_json(message)
-            
-            # 发送给发送者（如果不是同一个session）
-            if sender_session != target_session and sender_session in self.active_connections:
-                await self.active_connections[sender_session].send_json(message)
-        except Exception as e:
-            print(f"Error in send_private_message: {e}")
+        # 发送给目标用户，以及发送者（如果不是同一个session）
+        frame = encode_ws_message(message)
+        for session_id in {target_session, sender_session}:
+            if session_id in self.outboxes:
+                self.outboxes[session_id].send_text(frame)
 
 manager = ConnectionManager()
 
 # 简单连接管理（用于无需登录的聊天）
 simple_connections: Dict[str, dict] = {}
+ip_connections: Dict[str, set] = defaultdict(set)  # IP -> 该IP打开的连接ID，连接/断开时维护，私聊按它投递
+
+def add_simple_connection(connection_id: str, websocket: WebSocket, client_ip: str) -> WebSocketOutbox:
+    """登记一个简单连接，返回它的发送队列；写入任务由调用方在发送完历史后启动，
+    期间广播的消息先在队列中等待，保证排在历史消息之后"""
+    outbox = WebSocketOutbox(websocket, connection_id, on_close=lambda: remove_simple_connection(connection_id))
+    simple_connections[connection_id] = {
+        'websocket': websocket,
+        'outbox': outbox,
+        'ip': client_ip,
+        'connected_at': datetime.now()
+    }
+    ip_connections[client_ip].add(connection_id)
+    return outbox
+
+def remove_simple_connection(connection_id: str):
+    """移除一个简单连接（可重复调用）"""
+    connection_info = simple_connections.pop(connection_id, None)
+    if connection_info is None:
+        return
+    connection_info['outbox'].close()
+    connection_ids = ip_connections.get(connection_info['ip'])
+    if connection_ids is not None:
+        connection_ids.discard(connection_id)
+        if not connection_ids:
+            del ip_connections[connection_info['ip']]
 
 async def broadcast_simple_message(message: dict, exclude_id: str = None):
-    """广播消息给所有简单连接"""
-    disconnected_ids = []
-    
-    for connection_id, connection_info in simple_connections.items():
+    """广播消息给所有简单连接：只序列化一次并放入各连接的发送队列，不等待慢连接"""
+    frame = encode_ws_message(message)
+    for connection_id, connection_info in list(simple_connections.items()):
         if connection_id != exclude_id:
-            try:
-                await connection_info['websocket'].send_json(message)
-            except Exception as e:
-                print(f"Error sending message to {connection_id}: {e}")
-                disconnected_ids.append(connection_id)
-    
-    # 清理断开的连接
-    for connection_id in disconnected_ids:
-        if connection_id in simple_connections:
-            del simple_connections[connection_id]
+            connection_info['outbox'].send_text(frame)
+
+# 连接时的历史推送：历史消息按大小分成少量批量帧（history_batch），
+# 每个会话的帧只序列化一次，所有新连接共用；会话有新消息时作废它的缓存
+CHAT_HISTORY_FRAME_BYTES = 64 * 1024
+history_frame_cache: Dict[str, List[str]] = {}  # 会话键 -> 已序列化的批量帧
+
+def format_history_message(message: dict, private: bool) -> dict:
+    """确保历史消息格式正确"""
+    history_message = {
+        'message': message.get('message', ''),
+        'type': message.get('type', 'text'),
+        'ip': message.get('ip', 'unknown'),
+        'timestamp': message.get('timestamp', 0)
+    }
+    if private:
+        history_message['targetIp'] = message.get('targetIp', '')
+    if 'seq' in message:
+        history_message['seq'] = message['seq']
+    history_message['is_history'] = True
+    return history_message
+
+def build_history_frames(history_messages: List[dict]) -> List[str]:
+    """把已格式化的历史消息分成批量帧，每帧不超过 CHAT_HISTORY_FRAME_BYTES"""
+    frames = []
+    batch, batch_bytes = [], 0
+    for history_message in history_messages:
+        item = json.dumps(history_message, ensure_ascii=False)
+        item_bytes = len(item.encode("utf-8")) + 1
+        if batch and batch_bytes + item_bytes > CHAT_HISTORY_FRAME_BYTES:
+            frames.append('{"type": "history_batch", "messages": [' + ",".join(batch) + ']}')
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        frames.append('{"type": "history_batch", "messages": [' + ",".join(batch) + ']}')
+    return frames
+
+def get_history_frames(conversation: str, messages, private: bool) -> List[str]:
+    """会话历史的批量帧（按时间排序），结果缓存到会话有新消息为止"""
+    frames = history_frame_cache.get(conversation)
+    if frames is None:
+        frames = history_frame_cache[conversation] = build_history_frames([
+            format_history_message(message, private)
+            for message in sorted(messages, key=lambda x: x.get('timestamp', 0))
+        ])
+    return frames
+
+def private_conversations_of(ip: str) -> List[str]:
+    """IP参与的私聊会话键（精确匹配参与者，不按字符串包含判断）"""
+    return list(private_chat_participants.get(ip, ()))
 
-async def send_chat_history(websocket: WebSocket, client_ip: str):
-    """发送所有相关聊天历史给新连接的用户"""
+def history_reset_since(since: int) -> bool:
+    """客户端的本地历史是否已失效：之后服务端清空过历史，或序号来自已重置的服务端历史"""
+    return since > chat_store.seq or (chat_store.cleared_seq > 0 and since <= chat_store.cleared_seq)
+
+async def collect_history_delta(client_ip: str, since: int) -> Optional[List[dict]]:
+    """序号 since 之后的群聊和相关私聊消息；
+    内存中的最近消息可能已不完整（或服务端历史已重置）时返回 None，改为发送完整历史"""
+    if history_reset_since(since):
+        return None
+    conversations = [(global_chat_history, False)]
+    for chat_key in private_conversations_of(client_ip):
+        conversations.append((await private_chat_storage.load(chat_key), True))
+    delta = []
+    for messages, private in conversations:
+        # 会话已满时更早的消息被淘汰过，最旧的序号之前有缺口就无法只发增量
+        if messages and len(messages) == messages.maxlen and min(m.get('seq', 0) for m in messages) > since + 1:
+            return None
+        delta.extend(format_history_message(m, private) for m in messages if m.get('seq', 0) > since)
+    delta.sort(key=lambda x: x.get('timestamp', 0))
+    return delta
+
+async def send_chat_history(websocket: WebSocket, client_ip: str, since: Optional[int] = None):
+    """发送所有相关聊天历史给新连接的用户；重连时带上最后收到的序号 since 则只发送增量，
+    断线期间历史被清空时先通知客户端丢弃本地历史，再发送完整历史"""
     try:
-        total_messages_sent = 0
+        latest_seq = chat_store.seq
+        reset = since is not None and history_reset_since(since)
+        if reset:
+            await websocket.send_json({'type': 'history_reset', 'seq': latest_seq})
+        elif since is not None:
+            delta = await collect_history_delta(client_ip, since)
+            if delta is not None:
+                for frame in build_history_frames(delta):
+                    await websocket.send_text(frame)
+                await websocket.send_json({'type': 'history_sync', 'mode': 'delta', 'seq': latest_seq, 'count': len(delta)})
+                print(f"发送增量历史给 {client_ip}: 序号 {since} 之后 {len(delta)} 条")
+                return
         
         # 发送群聊历史
+        group_messages_sent = len(global_chat_history)
         if global_chat_history:
             await websocket.send_json({
                 'type': 'history_start',
                 'message': '正在加载群聊历史...'
             })
-            
-            # 按时间排序发送群聊历史
-            sorted_group_messages = sorted(global_chat_history, key=lambda x: x.get('timestamp', 0))
-            for message in sorted_group_messages:
-                # 确保消息格式正确
-                history_message = {
-                    'message': message.get('message', ''),
-                    'type': message.get('type', 'text'),
-                    'ip': message.get('ip', 'unknown'),
-                    'timestamp': message.get('timestamp', 0),
-                    'is_history': True
-                }
-                
-                await websocket.send_json(history_message)
-                total_messages_sent += 1
-                
-                # 添加小延迟避免消息过快
-                await asyncio.sleep(0.01)
+            for frame in get_history_frames(GROUP_CONVERSATION, global_chat_history, private=False):
+                await websocket.send_text(frame)
         
         # 发送与该IP相关的所有私聊历史
         private_messages_sent = 0
-        for chat_key, messages in private_chat_storage.items():
-            # 检查这个对话是否涉及当前用户
-            if client_ip in chat_key:
+        for chat_key in private_conversations_of(client_ip):
+            messages = await private_chat_storage.load(chat_key)
+            if messages:
                 if private_messages_sent == 0:
                     await websocket.send_json({
                         'type': 'history_start',
                         'message': '正在加载私聊历史...'
                     })
-                
-                # 按时间排序发送私聊历史
-                sorted_private_messages = sorted(messages, key=lambda x: x.get('timestamp', 0))
-                for message in sorted_private_messages:
-                    # 确保消息格式正确
-                    history_message = {
-                        'message': message.get('message', ''),
-                        'type': message.get('type', 'text'),
-                        'ip': message.get('ip', 'unknown'),
-                        'timestamp': message.get('timestamp', 0),
-                        'targetIp': message.get('targetIp', ''),
-                        'is_history': True
-                    }
-                    
-                    await websocket.send_json(history_message)
-                    private_messages_sent += 1
-                    total_messages_sent += 1
-                    
-                    # 添加小延迟避免消息过快
-                    await asyncio.sleep(0.01)
+                for frame in get_history_frames(chat_key, messages, private=True):
+                    await websocket.send_text(frame)
+                private_messages_sent += len(messages)
         
         # 发送加载完成消息
-        if total_messages_sent > 0:
+        if group_messages_sent + private_messages_sent > 0:
             await websocket.send_json({
                 'type': 'history_end',
-                'message': f'历史消息加载完成 (群聊: {len(global_chat_history)} 条, 私聊: {private_messages_sent} 条)'
+                'message': f'历史消息加载完成 (群聊: {group_messages_sent} 条, 私聊: {private_messages_sent} 条)'
             })
-            print(f"发送历史消息给 {client_ip}: 群聊 {len(global_chat_history)} 条, 私聊 {private_messages_sent} 条")
+            print(f"发送历史消息给 {client_ip}: 群聊 {group_messages_sent} 条, 私聊 {private_messages_sent} 条")
         else:
             print(f"没有历史消息发送给 {client_ip}")
+        await websocket.send_json({'type': 'history_sync', 'mode': 'snapshot', 'seq': latest_seq, 'reset': reset})
         
     except Exception as e:
         print(f"Error sending chat history: {e}")
@@ -463,27 +1892,25 @@ def add_to_global_history(message: dict):
             message['timestamp'] = datetime.now().timestamp() * 1000
             
         global_chat_history.append(message)
-        
-        # 异步保存到文件
-        asyncio.create_task(save_group_history())
+        history_frame_cache.pop(GROUP_CONVERSATION, None)
+        chat_store.add_message(GROUP_CONVERSATION, message)
 
 def add_to_private_history(message: dict, ip1: str, ip2: str):
     """添加消息到私聊历史记录"""
-    # 创建统一的聊天键（按字典序排序确保一致性）
-    chat_key = "_".join(sorted([ip1, ip2]))
+    chat_key = private_chat_key(ip1, ip2)
     
     # 确保时间戳存在
     if 'timestamp' not in message:
         message['timestamp'] = datetime.now().timestamp() * 1000
     
-    private_chat_storage[chat_key].append(message)
-    
-    # 异步保存到文件
-    asyncio.create_task(save_private_history())
+    private_chat_storage.append(chat_key, message, known=chat_key in private_chat_participants.get(ip1, ()))
+    private_chat_participants[ip1].add(chat_key)
+    private_chat_participants[ip2].add(chat_key)
+    history_frame_cache.pop(chat_key, None)
+    chat_store.add_message(chat_key, message, (ip1, ip2))
 
 async def broadcast_private_message(message: dict, target_ip: str, sender_id: str):
     """发送私聊消息给特定IP用户"""
-    disconnected_ids = []
     message_sent = False
     sender_ip = None
     
@@ -491,35 +1918,27 @@ async def broadcast_private_message(message: dict, target_ip: str, sender_id: st
     if sender_id in simple_connections:
         sender_ip = simple_connections[sender_id]['ip']
     
-    for connection_id, connection_info in simple_connections.items():
-        # 发送给目标IP或发送者
-        if connection_info['ip'] == target_ip or connection_id == sender_id:
-            try:
-                await connection_info['websocket'].send_json(message)
-                message_sent = True
-            except Exception as e:
-                print(f"Error sending private message to {connection_id}: {e}")
-                disconnected_ids.append(connection_id)
-    
-    # 保存私聊消息到历史记录
+    # 先保存私聊消息到历史记录（分配序号），发出的消息带有序号
     if sender_ip and sender_ip != target_ip:
         add_to_private_history(message, sender_ip, target_ip)
     
-    # 清理断开的连接
-    for connection_id in disconnected_ids:
-        if connection_id in simple_connections:
-            del simple_connections[connection_id]
+    # 只遍历目标IP的连接和发送者自己，不扫描全部连接
+    target_ids = set(ip_connections.get(target_ip, ()))
+    recipient_ids = target_ids | ({sender_id} if sender_id in simple_connections else set())
+    frame = encode_ws_message(message)
+    for connection_id in recipient_ids:
+        connection_info = simple_connections.get(connection_id)
+        # 只有进入目标用户的发送队列才算在线，回显给发送者不算
+        if connection_info is not None and connection_info['outbox'].send_text(frame) and connection_id in target_ids:
+            message_sent = True
     
     if not message_sent and sender_id in simple_connections:
-        try:
-            await simple_connections[sender_id]['websocket'].send_json({
-                'type': 'system',
-                'message': f'用户 {target_ip} 不在线，消息已保存',
-                'ip': 'system',
-                'timestamp': datetime.now().timestamp() * 1000
-            })
-        except Exception as e:
-            print(f"Error sending offline message notification: {e}")
+        simple_connections[sender_id]['outbox'].send_json({
+            'type': 'system',
+            'message': f'用户 {target_ip} 不在线，消息已保存',
+            'ip': 'system',
+            'timestamp': datetime.now().timestamp() * 1000
+        })
 
 # 用户认证相关端点
 @app.post("/login")
@@ -635,262 +2054,1160 @@ async def get_private_chat_history(session_id: str, target_username: str, limit:
     chat_pair = tuple(sorted([current_user.username, target_username]))
     chat_key = f"{chat_pair[0]}_{chat_pair[1]}"
     
-    messages = private_chat_history.get(chat_key, [])
-    recent_messages = messages[-limit:] if len(messages) > limit else messages
+    messages = private_chat_history.get(chat_key, [])
+    recent_messages = messages[-limit:] if len(messages) > limit else messages
+    
+    return {
+        "messages": [
+            {
+                "id": msg.id,
+                "username": msg.username,
+                "message": msg.message,
+                "message_type": msg.message_type,
+                "timestamp": msg.timestamp.isoformat(),
+                "target_user": msg.target_user
+            }
+            for msg in recent_messages
+        ]
+    }
+
+# 页面模板缓存：文件修改时间不变时直接使用内存中的内容
+template_cache: Dict[str, tuple] = {}
+
+def read_template(path: str) -> str:
+    """读取HTML模板，按修改时间缓存"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = template_cache.get(path)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    template_cache[path] = (mtime_ns, content)
+    return content
+
+@app.get("/")
+async def read_root(request: Request, auth: bool = Depends(conditional_auth)):
+    """
+    主页面路由 - 对127.0.0.1访问需要身份验证
+    """
+    # 条件认证已经在依赖项中处理
+    return HTMLResponse(content=await run_io(read_template, "templates/index.html"))
+
+@app.get("/login")
+async def login_page(request: Request, auth: bool = Depends(conditional_auth)):
+    """登录页面 - 对127.0.0.1访问需要身份验证"""
+    return HTMLResponse(content=await run_io(read_template, "templates/login.html"))
+
+def get_uploader_info(session_id: Optional[str], request: Request):
+    """获取上传者信息，返回 (用户名, IP)"""
+    if session_id and session_id in active_users:
+        # 使用登录用户信息
+        user = active_users[session_id]
+        print(f"使用登录用户信息: {user.username} ({user.ip})")
+        return user.username, user.ip
+    
+    # 使用简化模式，直接使用IP
+    uploader_ip = get_real_client_ip(request=request)
+    # 优化用户名显示：如果有映射名称就直接使用，否则显示"用户_IP"
+    mapped_name = ip_vs_name.get(str(uploader_ip))
+    if mapped_name:
+        uploader_username = mapped_name + "@" + uploader_ip
+        print(f"uploader_username: {uploader_username}({uploader_ip})")
+    else:
+        uploader_username = f"用户ip_{uploader_ip}"
+        print(f"使用IP模式: {uploader_username}")
+    return uploader_username, uploader_ip
+
+def resolve_upload_target(
+    original_filename: str,
+    relative_path: Optional[str] = None,
+    target_folder: Optional[str] = None,
+    custom_filename: Optional[str] = None
+):
+    """计算上传文件的保存位置，返回 (完整路径, 相对路径, 文件名)"""
+    # 处理文件夹结构上传
+    if relative_path:
+        print(f"处理文件夹上传: {relative_path}, target_folder: {target_folder}")
+        # 文件夹上传，保持目录结构
+        file_dir = os.path.dirname(relative_path)
+        
+        # 文件夹上传时，relative_path 已经包含完整的文件夹结构
+        # 检查是否是同名文件夹重复的情况
+        if target_folder and relative_path.startswith(target_folder + "/"):
+            # 用户在文件夹A内上传了同名文件夹A，这通常意味着要替换当前文件夹
+            # 将文件上传到根目录，避免路径重复
+            print(f"检测到同名文件夹上传，将上传到根目录")
+            full_dir = os.path.join(UPLOAD_DIR, file_dir) if file_dir else UPLOAD_DIR
+            relative_file_path = relative_path
+        elif target_folder:
+            # 正常的在文件夹内上传其他文件夹的情况
+            full_dir = os.path.join(UPLOAD_DIR, target_folder, file_dir) if file_dir else os.path.join(UPLOAD_DIR, target_folder)
+            relative_file_path = os.path.join(target_folder, relative_path)
+        else:
+            # 在根目录上传文件夹
+            full_dir = os.path.join(UPLOAD_DIR, file_dir) if file_dir else UPLOAD_DIR
+            relative_file_path = relative_path
+        
+        # 使用原始文件名，不添加时间戳
+        # 对于文件夹上传，file.filename 可能包含完整路径，我们只需要文件名部分
+        filename = custom_filename or os.path.basename(relative_path)
+    else:
+        print(f"处理普通文件上传: {original_filename}")
+        # 普通文件上传
+        if custom_filename:
+            # 使用自定义文件名
+            filename = custom_filename
+        else:
+            # 使用时间戳前缀的原始文件名
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f"{timestamp}_{original_filename}"
+        
+        if target_folder:
+            full_dir = os.path.join(UPLOAD_DIR, target_folder)
+            relative_file_path = os.path.join(target_folder, filename)
+        else:
+            full_dir = UPLOAD_DIR
+            relative_file_path = filename
+    
+    # 确保目录存在
+    if not os.path.exists(full_dir):
+        os.makedirs(full_dir, exist_ok=True)
+        print(f"创建目录: {full_dir}")
+    
+    file_path = os.path.join(full_dir, filename)
+    print(f"最终路径 - file_path: {file_path}, relative_file_path: {relative_file_path}")
+    return file_path, relative_file_path, filename
+
+def build_upload_metadata(
+    filename: str,
+    original_name: str,
+    uploader_username: str,
+    uploader_ip: str,
+    comment: Optional[str],
+    total_size: int,
+    sha256: Optional[str] = None
+) -> dict:
+    """生成上传文件的元数据"""
+    return {
+        "filename": filename,
+        "original_name": original_name,
+        "uploader_username": uploader_username,
+        "uploader_ip": uploader_ip,
+        "comment": comment,
+        "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "file_size": total_size,
+        "sha256": sha256
+    }
+
+async def write_upload_metadata(
+    file_path: str,
+    filename: str,
+    original_name: str,
+    uploader_username: str,
+    uploader_ip: str,
+    comment: Optional[str],
+    total_size: int,
+    sha256: Optional[str] = None
+) -> dict:
+    """写入上传文件的 .meta 元数据文件并更新索引"""
+    metadata = build_upload_metadata(
+        filename, original_name, uploader_username, uploader_ip, comment, total_size, sha256
+    )
+    
+    metadata_path = file_path + ".meta"
+    async with aiofiles.open(metadata_path, "w", encoding="utf-8", executor=io_executor) as f:
+        await f.write(json.dumps(metadata, ensure_ascii=False))
+    await run_io(file_index.upsert, to_relative_path(file_path))
+    return metadata
+
+@app.post("/upload")
+async def upload_file(
+    file: UploadFile = File(...),
+    comment: str = Form(None),
+    session_id: str = Form(None),  # 改为可选参数
+    relative_path: str = Form(None),  # 文件夹相对路径
+    target_folder: str = Form(None),  # 目标文件夹
+    custom_filename: str = Form(None),  # 自定义文件名
+    request: Request = None
+):
+    try:
+        # 获取用户信息
+        uploader_username, uploader_ip = get_uploader_info(session_id, request)
+    except Exception as e:
+        print(f"获取用户信息时出错: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"获取用户信息失败: {str(e)}")
+    
+    try:
+        file_path, relative_file_path, filename = await run_io(
+            resolve_upload_target, file.filename, relative_path, target_folder, custom_filename
+        )
+        print(f"文件将保存到: {file_path}")
+    except Exception as e:
+        print(f"处理文件路径时出错: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"处理文件路径失败: {str(e)}")
+    
+    # 进一步优化大文件传输 - 局域网高速传输配置
+    # 将chunk_size增加到16MB，最大化局域网传输效率
+    chunk_size = 16 * 1024 * 1024  # 16MB chunks for maximum LAN performance
+    total_size = 0
+    hasher = hashlib.sha256()
+    
+    try:
+        print(f"开始写入文件到: {file_path}")
+        # 目标可能是去重存储的硬链接，先解除链接，避免覆盖共享的数据
+        previous_sha256 = await run_io(previous_blob_sha256, file_path)
+        await run_io(remove_if_exists, file_path)
+        # 高性能异步文件写入，专为局域网大文件传输优化
+        async with aiofiles.open(file_path, "wb", buffering=chunk_size, executor=io_executor) as f:
+            # 移除所有延迟和控制权释放，让传输尽可能快
+            while chunk := await file.read(chunk_size):
+                # 写入和计算哈希在线程池中并行进行（hashlib 计算时释放GIL）
+                await asyncio.gather(f.write(chunk), run_io(hasher.update, chunk))
+                total_size += len(chunk)
+                # 完全移除延迟 - 局域网环境下无需限速
+        print(f"文件写入成功: {file_path}, 大小: {total_size}")
+    except Exception as e:
+        print(f"文件写入失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        # 清理失败的文件
+        await run_io(remove_if_exists, file_path)
+        raise HTTPException(status_code=500, detail=f"文件写入失败: {str(e)}")
+    
+    # 放入去重存储，覆盖的旧内容不再被引用时立即释放
+    sha256 = hasher.hexdigest()
+    deduplicated = await run_io(store_blob, file_path, sha256)
+    await run_io(release_blob, previous_sha256)
+    
+    # 异步写入元数据
+    await write_upload_metadata(
+        file_path, filename, file.filename, uploader_username, uploader_ip, comment, total_size, sha256
+    )
+    
+    return {
+        "filename": filename,
+        "path": f"/uploads/{relative_file_path}",
+        "relative_path": relative_file_path,
+        "uploader_username": uploader_username,
+        "comment": comment,
+        "size": total_size,
+        "sha256": sha256,
+        "deduplicated": deduplicated,
+        "is_folder_upload": bool(relative_path)
+    }
+
+# 流式上传：请求体就是文件的原始字节，直接写入最终路径，
+# 不经过 python-multipart 的临时文件，避免每个字节写两次磁盘
+STREAM_WRITE_BUFFER = 4 * 1024 * 1024  # 攒够4MB再写一次磁盘，减少线程切换
+
+@app.post("/upload/stream")
+async def upload_file_stream(
+    request: Request,
+    filename: str,
+    comment: str = None,
+    session_id: str = None,
+    relative_path: str = None,
+    target_folder: str = None,
+    custom_filename: str = None
+):
+    """流式上传文件，文件名和其他字段通过查询参数传递"""
+    if not filename or not filename.strip():
+        raise HTTPException(status_code=400, detail="文件名不能为空")
+    
+    try:
+        uploader_username, uploader_ip = get_uploader_info(session_id, request)
+    except Exception as e:
+        print(f"获取用户信息时出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取用户信息失败: {str(e)}")
+    
+    try:
+        file_path, relative_file_path, target_name = await run_io(
+            resolve_upload_target, filename, relative_path, target_folder, custom_filename
+        )
+    except Exception as e:
+        print(f"处理文件路径时出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"处理文件路径失败: {str(e)}")
+    
+    total_size = 0
+    hasher = hashlib.sha256()
+    try:
+        print(f"开始流式写入文件到: {file_path}")
+        # 目标可能是去重存储的硬链接，先解除链接，避免覆盖共享的数据
+        previous_sha256 = await run_io(previous_blob_sha256, file_path)
+        await run_io(remove_if_exists, file_path)
+        async with aiofiles.open(file_path, "wb", executor=io_executor) as f:
+            buffer = bytearray()
+            async for data in request.stream():
+                buffer += data
+                if len(buffer) >= STREAM_WRITE_BUFFER:
+                    await asyncio.gather(f.write(buffer), run_io(hasher.update, buffer))
+                    total_size += len(buffer)
+                    buffer = bytearray()
+            if buffer:
+                await asyncio.gather(f.write(buffer), run_io(hasher.update, buffer))
+                total_size += len(buffer)
+        print(f"文件写入成功: {file_path}, 大小: {total_size}")
+    except BaseException as e:
+        print(f"文件写入失败: {e!r}")
+        # 清理失败的文件（包括客户端中途断开的情况）
+        await asyncio.shield(run_io(remove_if_exists, file_path))
+        if isinstance(e, Exception):
+            raise HTTPException(status_code=500, detail=f"文件写入失败: {str(e)}")
+        raise
+    
+    sha256 = hasher.hexdigest()
+    deduplicated = await run_io(store_blob, file_path, sha256)
+    await run_io(release_blob, previous_sha256)
+    
+    await write_upload_metadata(
+        file_path, target_name, filename, uploader_username, uploader_ip, comment, total_size, sha256
+    )
+    
+    return {
+        "filename": target_name,
+        "path": f"/uploads/{relative_file_path}",
+        "relative_path": relative_file_path,
+        "uploader_username": uploader_username,
+        "comment": comment,
+        "size": total_size,
+        "sha256": sha256,
+        "deduplicated": deduplicated,
+        "is_folder_upload": bool(relative_path)
+    }
+
+@app.post("/upload/instant")
+async def upload_file_instant(
+    sha256: str = Form(...),
+    filename: str = Form(...),
+    comment: str = Form(None),
+    session_id: str = Form(None),
+    relative_path: str = Form(None),
+    target_folder: str = Form(None),
+    custom_filename: str = Form(None),
+    request: Request = None
+):
+    """秒传：服务器已有相同内容时直接创建文件，客户端无需传输数据"""
+    sha256 = sha256.lower()
+    blob_path = get_blob_path(sha256)
+    if not await run_io(os.path.exists, blob_path):
+        raise HTTPException(status_code=404, detail="服务器上没有该文件内容，请正常上传")
+    
+    uploader_username, uploader_ip = get_uploader_info(session_id, request)
+    file_path, relative_file_path, target_name = await run_io(
+        resolve_upload_target, filename, relative_path, target_folder, custom_filename
+    )
+    previous_sha256 = await run_io(previous_blob_sha256, file_path)
+    await run_io(link_blob_to, sha256, file_path)
+    await run_io(release_blob, previous_sha256)
+    total_size = await run_io(os.path.getsize, file_path)
+    
+    await write_upload_metadata(
+        file_path, target_name, filename, uploader_username, uploader_ip, comment, total_size, sha256
+    )
+    print(f"秒传成功: {file_path}, 大小: {total_size}")
+    
+    return {
+        "filename": target_name,
+        "path": f"/uploads/{relative_file_path}",
+        "relative_path": relative_file_path,
+        "uploader_username": uploader_username,
+        "comment": comment,
+        "size": total_size,
+        "sha256": sha256,
+        "deduplicated": True,
+        "is_folder_upload": bool(relative_path)
+    }
+
+# 文件夹打包上传：整个文件夹作为一个 tar（或 zip）流上传，边接收边解包，
+# 避免上万个小文件对应上万次 HTTP 请求
+ARCHIVE_METADATA_BATCH_SIZE = 500  # 每解出多少个文件写一批元数据
+
+class RequestStreamReader:
+    """把异步的请求体流包装成同步文件对象，供工作线程中的 tarfile 读取"""
+    def __init__(self, request: Request, loop: asyncio.AbstractEventLoop):
+        self._stream = request.stream().__aiter__()
+        self._loop = loop
+        self._buffer = b""
+        self._eof = False
+    
+    def _fetch(self) -> bool:
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._stream.__anext__(), self._loop)
+            self._buffer += future.result()
+            return True
+        except StopAsyncIteration:
+            self._eof = True
+            return False
+    
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            if not self._fetch():
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def safe_archive_member_path(name: str) -> Optional[str]:
+    """规范化压缩包成员路径，拒绝绝对路径、上级目录和内部文件"""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or any(p == ".." or is_hidden_entry(p) for p in parts):
+        return None
+    return "/".join(parts)
+
+class ArchiveExtractor:
+    """把压缩包成员写入目标文件夹，批量写入元数据并汇总结果"""
+    def __init__(self, target_folder: str, uploader_username: str, uploader_ip: str, comment: Optional[str]):
+        self.target_folder = target_folder or ""
+        self.target_dir = os.path.join(UPLOAD_DIR, self.target_folder) if self.target_folder else UPLOAD_DIR
+        self.uploader_username = uploader_username
+        self.uploader_ip = uploader_ip
+        self.comment = comment
+        self.pending_metadata = []
+        self.pending_folders = []
+        self.files = 0
+        self.folders = 0
+        self.total_size = 0
+        self.deduplicated = 0
+        self.skipped = []
+    
+    def add_folder(self, member_name: str):
+        relative_path = safe_archive_member_path(member_name)
+        if relative_path is None:
+            self.skipped.append(member_name)
+            return
+        folder_path = os.path.join(self.target_dir, relative_path)
+        if not os.path.isdir(folder_path):
+            os.makedirs(folder_path, exist_ok=True)
+            self.pending_folders.append(folder_path)
+            self.folders += 1
+    
+    def add_file(self, member_name: str, fileobj):
+        relative_path = safe_archive_member_path(member_name)
+        if relative_path is None:
+            self.skipped.append(member_name)
+            return
+        file_path = os.path.join(self.target_dir, relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # 目标可能是去重存储的硬链接，先解除链接，避免覆盖共享的数据
+        previous_sha256 = previous_blob_sha256(file_path)
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        
+        hasher = hashlib.sha256()
+        size = 0
+        with open(file_path, "wb") as f:
+            while chunk := fileobj.read(FILE_RESPONSE_CHUNK_SIZE):
+                f.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+        sha256 = hasher.hexdigest()
+        if store_blob(file_path, sha256):
+            self.deduplicated += 1
+        release_blob(previous_sha256)
+        
+        file_name = os.path.basename(relative_path)
+        self.pending_metadata.append((file_path, build_upload_metadata(
+            file_name, file_name, self.uploader_username, self.uploader_ip, self.comment, size, sha256
+        )))
+        self.files += 1
+        self.total_size += size
+        if len(self.pending_metadata) >= ARCHIVE_METADATA_BATCH_SIZE:
+            self.flush_metadata()
+    
+    def flush_metadata(self):
+        for file_path, metadata in self.pending_metadata:
+            with open(file_path + ".meta", "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False)
+        # 整批在一个事务中写入索引
+        file_index.upsert_many(
+            [to_relative_path(p) for p in self.pending_folders]
+            + [to_relative_path(p) for p, _ in self.pending_metadata]
+        )
+        self.pending_metadata = []
+        self.pending_folders = []
+    
+    def extract_tar(self, fileobj):
+        # 流模式只顺序读取一次，不需要可随机访问的文件
+        with tarfile.open(fileobj=fileobj, mode="r|*", encoding="utf-8") as archive:
+            for member in archive:
+                if member.isdir():
+                    self.add_folder(member.name)
+                elif member.isfile():
+                    self.add_file(member.name, archive.extractfile(member))
+                else:
+                    # 符号链接、设备文件等不解包
+                    self.skipped.append(member.name)
+        self.flush_metadata()
+    
+    def extract_zip(self, zip_path: str):
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    self.add_folder(member.filename)
+                else:
+                    with archive.open(member) as fileobj:
+                        self.add_file(member.filename, fileobj)
+        self.flush_metadata()
+    
+    def summary(self) -> dict:
+        return {
+            "message": "文件夹上传完成",
+            "target_folder": self.target_folder,
+            "files": self.files,
+            "folders": self.folders,
+            "total_size": self.total_size,
+            "deduplicated": self.deduplicated,
+            "skipped": self.skipped
+        }
+
+@app.post("/upload/archive")
+async def upload_archive(
+    request: Request,
+    format: str = "tar",
+    target_folder: str = None,
+    comment: str = None,
+    session_id: str = None
+):
+    """上传一个 tar/zip 包并解包到目标文件夹，请求体为压缩包原始字节"""
+    if format not in ("tar", "zip"):
+        raise HTTPException(status_code=400, detail="只支持 tar 或 zip 格式")
+    
+    uploader_username, uploader_ip = get_uploader_info(session_id, request)
+    extractor = ArchiveExtractor(target_folder, uploader_username, uploader_ip, comment)
+    await run_io(os.makedirs, extractor.target_dir, exist_ok=True)
+    
+    # 解包的速度取决于网络，整个上传期间都会占用线程，因此不放进有界的文件I/O线程池
+    try:
+        if format == "tar":
+            # tar 可以边接收边解包，在工作线程中读取请求流
+            reader = RequestStreamReader(request, asyncio.get_running_loop())
+            await asyncio.to_thread(extractor.extract_tar, reader)
+        else:
+            # zip 的目录在文件末尾，只能先落盘再解包
+            spool_path = os.path.join(PARTIAL_UPLOAD_DIR, f"{uuid.uuid4().hex}.zip")
+            try:
+                async with aiofiles.open(spool_path, "wb", executor=io_executor) as f:
+                    async for data in request.stream():
+                        await f.write(data)
+                await asyncio.to_thread(extractor.extract_zip, spool_path)
+            finally:
+                await run_io(remove_if_exists, spool_path)
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        await run_io(extractor.flush_metadata)
+        raise HTTPException(status_code=400, detail=f"压缩包格式错误: {str(e)}")
+    except Exception as e:
+        await run_io(extractor.flush_metadata)
+        print(f"解包上传失败: {e}")
+        raise HTTPException(status_code=500, detail=f"文件夹上传失败: {str(e)}")
+    
+    print(f"文件夹打包上传完成: {extractor.files} 个文件, {extractor.total_size} 字节 -> {extractor.target_dir}")
+    return extractor.summary()
+
+# 断点续传上传
+# 协议：创建上传会话 -> 按序号 PUT 分块 -> 查询已提交偏移量 -> 完成合并
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024  # 默认分块大小 8MB
+RESUMABLE_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+RESUMABLE_EXPIRE_SECONDS = 7 * 24 * 3600  # 未完成的上传保留7天
+resumable_locks: Dict[str, asyncio.Lock] = {}  # 规范化的 upload_id -> 写入锁
+
+def resumable_upload_key(upload_id: str) -> str:
+    """规范化上传ID，大小写或连字符不同的写法对应同一个会话"""
+    try:
+        return uuid.UUID(upload_id).hex
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的上传ID")
+
+def _resumable_paths(upload_id: str):
+    """返回上传会话的状态文件和数据文件路径"""
+    upload_id = resumable_upload_key(upload_id)
+    return (
+        os.path.join(PARTIAL_UPLOAD_DIR, f"{upload_id}.json"),
+        os.path.join(PARTIAL_UPLOAD_DIR, f"{upload_id}.part"),
+    )
+
+def load_resumable_session(upload_id: str) -> dict:
+    """读取上传会话状态"""
+    state_path, _ = _resumable_paths(upload_id)
+    if not os.path.exists(state_path):
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    with open(state_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_resumable_session(session: dict):
+    """保存上传会话状态（先写临时文件再替换，避免写一半）"""
+    state_path, _ = _resumable_paths(session["upload_id"])
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(session, f, ensure_ascii=False)
+    os.replace(tmp_path, state_path)
+
+def remove_resumable_session(upload_id: str):
+    """删除上传会话的状态和数据文件"""
+    for path in _resumable_paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+    resumable_locks.pop(resumable_upload_key(upload_id), None)
+
+async def get_resumable_lock(upload_id: str) -> asyncio.Lock:
+    """返回上传会话的写入锁，会话不存在时返回404，不为无效或已结束的会话创建锁"""
+    key = resumable_upload_key(upload_id)
+    lock = resumable_locks.get(key)
+    if lock is None:
+        await run_io(load_resumable_session, upload_id)
+        lock = resumable_locks.setdefault(key, asyncio.Lock())
+    return lock
+
+def resumable_status(session: dict) -> dict:
+    """上传会话对外返回的状态"""
+    if session.get("mode") == "parallel":
+        return parallel_upload_status(session)
+    return {
+        "upload_id": session["upload_id"],
+        "filename": session["filename"],
+        "total_size": session["total_size"],
+        "chunk_size": session["chunk_size"],
+        "total_chunks": session["total_chunks"],
+        "next_chunk": session["next_chunk"],
+        "offset": session["offset"],
+        "complete": session["offset"] >= session["total_size"]
+    }
+
+def cleanup_expired_resumable_uploads():
+    """清理过期的未完成上传"""
+    now = datetime.now().timestamp()
+    removed = 0
+    for item_name in os.listdir(PARTIAL_UPLOAD_DIR):
+        if not item_name.endswith(".json"):
+            continue
+        state_path = os.path.join(PARTIAL_UPLOAD_DIR, item_name)
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                session = json.load(f)
+            if now - session.get("updated_at", 0) > RESUMABLE_EXPIRE_SECONDS:
+                remove_resumable_session(session["upload_id"])
+                removed += 1
+        except Exception as e:
+            print(f"清理上传会话 {item_name} 失败: {e}")
+    if removed:
+        print(f"清理过期上传会话: {removed} 个")
+
+def new_upload_session(
+    filename: str,
+    total_size: int,
+    comment: Optional[str],
+    session_id: Optional[str],
+    relative_path: Optional[str],
+    target_folder: Optional[str],
+    custom_filename: Optional[str],
+    request: Request
+) -> dict:
+    """创建上传会话的公共字段（断点续传和并行分片上传共用）"""
+    uploader_username, uploader_ip = get_uploader_info(session_id, request)
+    
+    # 在创建时确定最终路径，保证时间戳文件名在续传期间不变
+    file_path, relative_file_path, target_name = resolve_upload_target(
+        filename, relative_path, target_folder, custom_filename
+    )
+    
+    now = datetime.now().timestamp()
+    return {
+        "upload_id": uuid.uuid4().hex,
+        "filename": target_name,
+        "original_name": filename,
+        "file_path": file_path,
+        "relative_path": relative_file_path,
+        "is_folder_upload": bool(relative_path),
+        "uploader_username": uploader_username,
+        "uploader_ip": uploader_ip,
+        "comment": comment,
+        "total_size": total_size,
+        "created_at": now,
+        "updated_at": now
+    }
+
+async def finalize_upload_session(session: dict) -> dict:
+    """把已上传完整的数据文件移动到最终路径并写入元数据"""
+    upload_id = session["upload_id"]
+    _, part_path = _resumable_paths(upload_id)
+    file_path = session["file_path"]
+    await run_io(os.makedirs, os.path.dirname(file_path), exist_ok=True)
+    previous_sha256 = await run_io(previous_blob_sha256, file_path)
+    await run_io(os.replace, part_path, file_path)
+    
+    # 分块可能乱序到达，只能在合并后统一计算哈希
+    sha256 = await run_io(hash_file, file_path)
+    deduplicated = await run_io(store_blob, file_path, sha256)
+    await run_io(release_blob, previous_sha256)
+    
+    await write_upload_metadata(
+        file_path,
+        session["filename"],
+        session["original_name"],
+        session["uploader_username"],
+        session["uploader_ip"],
+        session["comment"],
+        session["total_size"],
+        sha256
+    )
+    await run_io(remove_resumable_session, upload_id)
+    print(f"上传完成: {file_path}, 大小: {session['total_size']}")
+    
+    return {
+        "filename": session["filename"],
+        "path": f"/uploads/{session['relative_path']}",
+        "relative_path": session["relative_path"],
+        "uploader_username": session["uploader_username"],
+        "comment": session["comment"],
+        "size": session["total_size"],
+        "sha256": sha256,
+        "deduplicated": deduplicated,
+        "is_folder_upload": session["is_folder_upload"]
+    }
+
+@app.post("/upload/resumable")
+async def create_resumable_upload(
+    filename: str = Form(...),
+    total_size: int = Form(...),
+    chunk_size: int = Form(None),
+    comment: str = Form(None),
+    session_id: str = Form(None),
+    relative_path: str = Form(None),
+    target_folder: str = Form(None),
+    custom_filename: str = Form(None),
+    request: Request = None
+):
+    """创建断点续传上传会话"""
+    if total_size < 0:
+        raise HTTPException(status_code=400, detail="文件大小无效")
+    chunk_size = chunk_size or RESUMABLE_CHUNK_SIZE
+    if chunk_size <= 0 or chunk_size > RESUMABLE_MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail="分块大小无效")
+    
+    session = await run_io(
+        new_upload_session,
+        filename, total_size, comment, session_id, relative_path, target_folder, custom_filename, request
+    )
+    session.update({
+        "mode": "resumable",
+        "chunk_size": chunk_size,
+        "total_chunks": (total_size + chunk_size - 1) // chunk_size,
+        "next_chunk": 0,
+        "offset": 0
+    })
+    
+    _, part_path = _resumable_paths(session["upload_id"])
+    await run_io(preallocate_file, part_path, 0)
+    await run_io(save_resumable_session, session)
+    print(f"创建断点续传会话: {session['upload_id']} -> {session['file_path']} ({total_size} 字节)")
     
+    return resumable_status(session)
+
+@app.get("/upload/resumable/{upload_id}")
+async def get_resumable_upload(upload_id: str):
+    """查询上传会话已提交的偏移量"""
+    return resumable_status(await run_io(load_resumable_session, upload_id))
+
+@app.put("/upload/resumable/{upload_id}/{chunk_index}")
+async def put_resumable_chunk(upload_id: str, chunk_index: int, request: Request):
+    """上传一个分块，请求体为分块的原始字节"""
+    async with await get_resumable_lock(upload_id):
+        session = await run_io(load_resumable_session, upload_id)
+        if session.get("mode") != "resumable":
+            raise HTTPException(status_code=400, detail="上传会话类型不匹配")
+        next_chunk = session["next_chunk"]
+        
+        # 已提交的分块重复上传时直接返回当前状态（客户端重试是安全的）
+        if chunk_index < next_chunk:
+            return resumable_status(session)
+        if chunk_index > next_chunk or chunk_index >= session["total_chunks"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"分块序号不连续，下一个分块应为 {next_chunk}"
+            )
+        
+        offset = session["offset"]
+        expected_size = min(session["chunk_size"], session["total_size"] - offset)
+        _, part_path = _resumable_paths(upload_id)
+        received = 0
+        
+        try:
+            async with aiofiles.open(part_path, "r+b", executor=io_executor) as f:
+                await f.seek(offset)
+                async for data in request.stream():
+                    received += len(data)
+                    if received > expected_size:
+                        break
+                    await f.write(data)
+            
+            if received != expected_size:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"分块大小不正确: 期望 {expected_size} 字节, 收到 {received} 字节"
+                )
+        except BaseException:
+            # 丢弃未完整写入的数据，偏移量保持在上一个已提交的位置
+            await asyncio.shield(run_io(os.truncate, part_path, offset))
+            raise
+        
+        session["next_chunk"] = next_chunk + 1
+        session["offset"] = offset + received
+        session["updated_at"] = datetime.now().timestamp()
+        await run_io(save_resumable_session, session)
+        return resumable_status(session)
+
+@app.post("/upload/resumable/{upload_id}/complete")
+async def complete_resumable_upload(upload_id: str):
+    """所有分块上传完成后，合并到最终路径并写入元数据"""
+    async with await get_resumable_lock(upload_id):
+        session = await run_io(load_resumable_session, upload_id)
+        if session.get("mode") != "resumable":
+            raise HTTPException(status_code=400, detail="上传会话类型不匹配")
+        if session["offset"] < session["total_size"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"上传未完成: 已上传 {session['offset']} / {session['total_size']} 字节"
+            )
+        return await finalize_upload_session(session)
+
+# 并行分片上传
+# 客户端把文件切成 N 个字节区间，通过多个连接同时上传，服务器按偏移量写入预分配的文件，
+# 所有分片到齐后才移动到最终路径并写入 .meta
+PARALLEL_MAX_PARTS = 10000
+parallel_parts_in_progress: set = set()  # 正在写入的 (upload_id, part_index)
+
+def parallel_part_range(session: dict, part_index: int):
+    """返回分片的字节区间 [start, end)"""
+    start = part_index * session["part_size"]
+    end = min(start + session["part_size"], session["total_size"])
+    return start, end
+
+def parallel_upload_status(session: dict) -> dict:
+    """并行上传会话对外返回的状态"""
+    received = set(session["received_parts"])
+    received_bytes = sum(
+        end - start for start, end in (parallel_part_range(session, i) for i in received)
+    )
     return {
-        "messages": [
-            {
-                "id": msg.id,
-                "username": msg.username,
-                "message": msg.message,
-                "message_type": msg.message_type,
-                "timestamp": msg.timestamp.isoformat(),
-                "target_user": msg.target_user
-            }
-            for msg in recent_messages
-        ]
+        "upload_id": session["upload_id"],
+        "filename": session["filename"],
+        "total_size": session["total_size"],
+        "part_size": session["part_size"],
+        "part_count": session["part_count"],
+        "received_parts": sorted(received),
+        "missing_parts": [i for i in range(session["part_count"]) if i not in received],
+        "received_bytes": received_bytes,
+        "complete": len(received) == session["part_count"]
     }
 
-@app.get("/")
-async def read_root(request: Request, auth: bool = Depends(conditional_auth)):
-    """
-    主页面路由 - 对127.0.0.1访问需要身份验证
-    """
-    # 条件认证已经在依赖项中处理
-    with open("templates/index.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    return HTMLResponse(content=html_content)
-
-@app.get("/login")
-async def login_page(request: Request, auth: bool = Depends(conditional_auth)):
-    """登录页面 - 对127.0.0.1访问需要身份验证"""
-    with open("templates/login.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    return HTMLResponse(content=html_content)
+def preallocate_file(path: str, size: int):
+    """创建并预分配指定大小的文件"""
+    with open(path, "wb") as f:
+        if size > 0:
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                    return
+                except OSError:
+                    pass  # 文件系统不支持时退回到稀疏文件
+            f.truncate(size)
 
-@app.post("/upload")
-async def upload_file(
-    file: UploadFile = File(...),
+@app.post("/upload/parallel")
+async def create_parallel_upload(
+    filename: str = Form(...),
+    total_size: int = Form(...),
+    part_count: int = Form(...),
     comment: str = Form(None),
-    session_id: str = Form(None),  # 改为可选参数
-    relative_path: str = Form(None),  # 文件夹相对路径
-    target_folder: str = Form(None),  # 目标文件夹
-    custom_filename: str = Form(None),  # 自定义文件名
+    session_id: str = Form(None),
+    relative_path: str = Form(None),
+    target_folder: str = Form(None),
+    custom_filename: str = Form(None),
     request: Request = None
 ):
-    try:
-        # 获取用户信息
-        if session_id and session_id in active_users:
-            # 使用登录用户信息
-            user = active_users[session_id]
-            uploader_username = user.username
-            uploader_ip = user.ip
-            print(f"使用登录用户信息: {uploader_username} ({uploader_ip})")
-        else:
-            # 使用简化模式，直接使用IP
-            uploader_ip = get_real_client_ip(request=request)
-            # 优化用户名显示：如果有映射名称就直接使用，否则显示"用户_IP"
-            mapped_name = ip_vs_name.get(str(uploader_ip))
-            if mapped_name:
-                uploader_username = mapped_name + "@" + uploader_ip
-                print(f"uploader_username: {uploader_username}({uploader_ip})")
-            else:
-                uploader_username = f"用户ip_{uploader_ip}"
-                print(f"使用IP模式: {uploader_username}")
-    except Exception as e:
-        print(f"获取用户信息时出错: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"获取用户信息失败: {str(e)}")
+    """创建并行分片上传会话，返回每个分片的字节区间"""
+    if total_size < 0:
+        raise HTTPException(status_code=400, detail="文件大小无效")
+    if part_count <= 0 or part_count > PARALLEL_MAX_PARTS:
+        raise HTTPException(status_code=400, detail="分片数量无效")
     
-    try:
-        # 处理文件夹结构上传
-        if relative_path:
-            print(f"处理文件夹上传: {relative_path}, target_folder: {target_folder}")
-            # 文件夹上传，保持目录结构
-            file_dir = os.path.dirname(relative_path)
-            print(f"file_dir: {file_dir}")
-            
-            # 文件夹上传时，relative_path 已经包含完整的文件夹结构
-            # 检查是否是同名文件夹重复的情况
-            if target_folder and relative_path.startswith(target_folder + "/"):
-                # 用户在文件夹A内上传了同名文件夹A，这通常意味着要替换当前文件夹
-                # 将文件上传到根目录，避免路径重复
-                print(f"检测到同名文件夹上传，将上传到根目录")
-                full_dir = os.path.join(UPLOAD_DIR, file_dir) if file_dir else UPLOAD_DIR
-                relative_file_path = relative_path
-            elif target_folder:
-                # 正常的在文件夹内上传其他文件夹的情况
-                full_dir = os.path.join(UPLOAD_DIR, target_folder, file_dir) if file_dir else os.path.join(UPLOAD_DIR, target_folder)
-                relative_file_path = os.path.join(target_folder, relative_path)
-            else:
-                # 在根目录上传文件夹
-                full_dir = os.path.join(UPLOAD_DIR, file_dir) if file_dir else UPLOAD_DIR
-                relative_file_path = relative_path
-            
-            print(f"最终路径 - full_dir: {full_dir}, relative_file_path: {relative_file_path}")
-            
-            # 确保目录存在
-            if not os.path.exists(full_dir):
-                os.makedirs(full_dir, exist_ok=True)
-                print(f"创建目录: {full_dir}")
-            
-            # 使用原始文件名，不添加时间戳
-            # 对于文件夹上传，file.filename 可能包含完整路径，我们只需要文件名部分
-            if custom_filename:
-                filename = custom_filename
-            else:
-                filename = os.path.basename(relative_path)  # 从 relative_path 中提取文件名
-            print(f"file.filename: {file.filename}")
-            print(f"使用的filename: {filename}")
-            file_path = os.path.join(full_dir, filename)
-            print(f"计算出的 file_path: {file_path}")
-        else:
-            print(f"处理普通文件上传: {file.filename}")
-            # 普通文件上传
-            if custom_filename:
-                # 使用自定义文件名
-                filename = custom_filename
-            else:
-                # 使用时间戳前缀的原始文件名
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"{timestamp}_{file.filename}"
-            
-            if target_folder:
-                full_dir = os.path.join(UPLOAD_DIR, target_folder)
-                if not os.path.exists(full_dir):
-                    os.makedirs(full_dir, exist_ok=True)
-                    print(f"创建目标目录: {full_dir}")
-                file_path = os.path.join(full_dir, filename)
-                relative_file_path = os.path.join(target_folder, filename)
-            else:
-                file_path = os.path.join(UPLOAD_DIR, filename)
-                relative_file_path = filename
-        
-        print(f"文件将保存到: {file_path}")
-    except Exception as e:
-        print(f"处理文件路径时出错: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"处理文件路径失败: {str(e)}")
+    part_size = max(1, (total_size + part_count - 1) // part_count)
+    # 文件较小时实际分片数可能少于请求的数量
+    part_count = max(1, (total_size + part_size - 1) // part_size)
     
-    # 进一步优化大文件传输 - 局域网高速传输配置
-    # 将chunk_size增加到16MB，最大化局域网传输效率
-    chunk_size = 16 * 1024 * 1024  # 16MB chunks for maximum LAN performance
-    total_size = 0
+    session = await run_io(
+        new_upload_session,
+        filename, total_size, comment, session_id, relative_path, target_folder, custom_filename, request
+    )
+    session.update({
+        "mode": "parallel",
+        "part_size": part_size,
+        "part_count": part_count,
+        "received_parts": []
+    })
+    
+    _, part_path = _resumable_paths(session["upload_id"])
+    await run_io(preallocate_file, part_path, total_size)
+    await run_io(save_resumable_session, session)
+    print(f"创建并行上传会话: {session['upload_id']} -> {session['file_path']} ({total_size} 字节, {part_count} 个分片)")
+    
+    status = parallel_upload_status(session)
+    status["parts"] = [
+        {"index": i, "start": start, "end": end}
+        for i, (start, end) in ((i, parallel_part_range(session, i)) for i in range(part_count))
+    ]
+    return status
+
+@app.get("/upload/parallel/{upload_id}")
+async def get_parallel_upload(upload_id: str):
+    """查询并行上传会话已收到的分片"""
+    return parallel_upload_status(await run_io(load_resumable_session, upload_id))
+
+@app.put("/upload/parallel/{upload_id}/{part_index}")
+async def put_parallel_part(upload_id: str, part_index: int, request: Request):
+    """上传一个分片，请求体为该分片区间的原始字节，多个分片可并发上传"""
+    session = await run_io(load_resumable_session, upload_id)
+    if session.get("mode") != "parallel":
+        raise HTTPException(status_code=400, detail="上传会话类型不匹配")
+    if part_index < 0 or part_index >= session["part_count"]:
+        raise HTTPException(status_code=400, detail="分片序号无效")
+    
+    # 同一分片不能同时被两个连接写入
+    busy_key = (resumable_upload_key(upload_id), part_index)
+    if busy_key in parallel_parts_in_progress:
+        raise HTTPException(status_code=409, detail="该分片正在上传中")
+    parallel_parts_in_progress.add(busy_key)
     
     try:
-        print(f"开始写入文件到: {file_path}")
-        # 验证文件路径的父目录是否存在
-        file_parent_dir = os.path.dirname(file_path)
-        if not os.path.exists(file_parent_dir):
-            print(f"父目录不存在，创建: {file_parent_dir}")
-            os.makedirs(file_parent_dir, exist_ok=True)
+        start, end = parallel_part_range(session, part_index)
+        expected_size = end - start
+        _, part_path = _resumable_paths(upload_id)
+        received = 0
         
-        # 高性能异步文件写入，专为局域网大文件传输优化
-        async with aiofiles.open(file_path, "wb", buffering=chunk_size) as f:
-            # 移除所有延迟和控制权释放，让传输尽可能快
-            while chunk := await file.read(chunk_size):
-                await f.write(chunk)
-                total_size += len(chunk)
-                # 完全移除延迟 - 局域网环境下无需限速
-        print(f"文件写入成功: {file_path}, 大小: {total_size}")
-    except Exception as e:
-        print(f"文件写入失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        # 清理失败的文件
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise HTTPException(status_code=500, detail=f"文件写入失败: {str(e)}")
+        # 每个分片使用独立的文件句柄，写入各自的偏移量，互不干扰
+        async with aiofiles.open(part_path, "r+b", executor=io_executor) as f:
+            await f.seek(start)
+            async for data in request.stream():
+                received += len(data)
+                if received > expected_size:
+                    break
+                await f.write(data)
+        
+        if received != expected_size:
+            raise HTTPException(
+                status_code=400,
+                detail=f"分片大小不正确: 期望 {expected_size} 字节, 收到 {received} 字节"
+            )
+        
+        # 重新读取最新状态再记录分片，避免并发请求互相覆盖
+        async with await get_resumable_lock(upload_id):
+            session = await run_io(load_resumable_session, upload_id)
+            if part_index not in session["received_parts"]:
+                session["received_parts"].append(part_index)
+            session["updated_at"] = datetime.now().timestamp()
+            await run_io(save_resumable_session, session)
+        return parallel_upload_status(session)
+    finally:
+        parallel_parts_in_progress.discard(busy_key)
+
+@app.post("/upload/parallel/{upload_id}/complete")
+async def complete_parallel_upload(upload_id: str):
+    """所有分片到齐后，移动到最终路径并写入元数据"""
+    async with await get_resumable_lock(upload_id):
+        session = await run_io(load_resumable_session, upload_id)
+        if session.get("mode") != "parallel":
+            raise HTTPException(status_code=400, detail="上传会话类型不匹配")
+        status = parallel_upload_status(session)
+        if not status["complete"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"上传未完成: 缺少分片 {status['missing_parts'][:20]}"
+            )
+        return await finalize_upload_session(session)
+
+@app.delete("/upload/parallel/{upload_id}")
+async def abort_parallel_upload(upload_id: str):
+    """放弃并行上传会话并删除已上传的数据"""
+    async with await get_resumable_lock(upload_id):
+        await run_io(load_resumable_session, upload_id)
+        await run_io(remove_resumable_session, upload_id)
+    return {"message": "上传已取消", "upload_id": upload_id}
+
+@app.delete("/upload/resumable/{upload_id}")
+async def abort_resumable_upload(upload_id: str):
+    """放弃上传会话并删除已上传的数据"""
+    async with await get_resumable_lock(upload_id):
+        await run_io(load_resumable_session, upload_id)
+        await run_io(remove_resumable_session, upload_id)
+    return {"message": "上传已取消", "upload_id": upload_id}
+
+# 文件列表分页
+FILES_PAGE_MAX_LIMIT = 1000
+
+def encode_files_cursor(sort_by: str, sort_order: str, search: str, last_key: list) -> str:
+    """生成不透明的分页游标，记录排序方式和上一页最后一项的排序键"""
+    payload = json.dumps({"s": sort_by, "o": sort_order, "q": search, "k": last_key}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_files_cursor(cursor: str, sort_by: str, sort_order: str, search: str) -> list:
+    """解析分页游标，排序或搜索条件变化后旧游标失效"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        last_key = payload["k"]
+        if not isinstance(last_key, list) or len(last_key) != 2:
+            raise ValueError("invalid key")
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    if (payload.get("s"), payload.get("o"), payload.get("q")) != (sort_by, sort_order, search):
+        raise HTTPException(status_code=400, detail="分页游标与当前排序或搜索条件不匹配，请重新加载")
+    return last_key
+
+# 文件列表缓存：按文件夹和查询参数缓存序列化后的响应，LRU淘汰并限制总内存
+FILES_CACHE_MAX_BYTES = int(os.environ.get("FILES_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+class ListingCache:
+    """文件列表响应缓存，文件变化时按路径让相关文件夹的缓存失效"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (etag, body)
+        self.total_bytes = 0
+        self.generation = 0  # 每次失效加一，防止把失效前计算的结果写回缓存
+        self.lock = threading.Lock()
     
-    # 异步写入元数据
-    metadata = {
-        "filename": filename,
-        "original_name": file.filename,
-        "uploader_username": uploader_username,
-        "uploader_ip": uploader_ip,
-        "comment": comment,
-        "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "file_size": total_size
-    }
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
     
-    metadata_path = file_path + ".meta"
-    async with aiofiles.open(metadata_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(metadata, ensure_ascii=False))
+    def put(self, key: tuple, etag: str, body: bytes, generation: int):
+        if len(body) > self.max_bytes // 4:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[1])
+            self.entries[key] = (etag, body)
+            self.total_bytes += len(body)
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+    
+    def invalidate(self, paths):
+        """路径变化影响它的所有上级文件夹，被删除或移动的文件夹还影响其下所有文件夹"""
+        changed = set(paths)
+        ancestors = set()
+        for path in changed:
+            while path and path not in ancestors:
+                ancestors.add(path)
+                path = posixpath.dirname(path)
+            ancestors.add("")
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                folder = key[0]
+                affected = folder in ancestors
+                while not affected and folder:
+                    folder = posixpath.dirname(folder)
+                    affected = folder in changed
+                if affected:
+                    self.total_bytes -= len(self.entries.pop(key)[1])
+
+listing_cache = ListingCache(FILES_CACHE_MAX_BYTES)
+file_change_listeners.append(listing_cache.invalidate)
+
+def build_files_listing(folder: str, sort_by: str, sort_order: str, search: str,
+                        limit: Optional[int], cursor: Optional[str]) -> dict:
+    """从文件索引生成一页文件列表"""
+    if not file_index.folder_exists(folder):
+        raise HTTPException(status_code=404, detail="文件夹不存在")
+    
+    if limit is not None and (limit <= 0 or limit > FILES_PAGE_MAX_LIMIT):
+        raise HTTPException(status_code=400, detail=f"limit 必须在 1 到 {FILES_PAGE_MAX_LIMIT} 之间")
+    after = decode_files_cursor(cursor, sort_by, sort_order, search) if cursor else None
+    
+    files, total, next_key = file_index.list_folder(folder, sort_by, sort_order, search, limit, after)
+    next_cursor = encode_files_cursor(sort_by, sort_order, search, next_key) if next_key else None
     
     return {
-        "filename": filename,
-        "path": f"/uploads/{relative_file_path}",
-        "relative_path": relative_file_path,
-        "uploader_username": uploader_username,
-        "comment": comment,
-        "size": total_size,
-        "is_folder_upload": bool(relative_path)
+        "files": files,
+        "current_folder": folder,
+        "parent_folder": os.path.dirname(folder) if folder else None,
+        "total": total,
+        "next_cursor": next_cursor
     }
 
 @app.get("/files")
 async def list_files(
+    request: Request,
     folder: str = "",
     sort_by: str = "name",  # name, time, uploader_ip, size
     sort_order: str = "asc",  # asc, desc
-    search: str = ""
+    search: str = "",
+    limit: int = None,  # 每页数量，不传则返回全部
+    cursor: str = None  # 上一页返回的 next_cursor
 ):
-    """获取文件列表，支持文件夹浏览、排序和搜索"""
+    """获取文件列表，支持文件夹浏览、排序、搜索和游标分页（由文件元数据索引提供，结果带ETag缓存）"""
     try:
-        # 确定当前目录
-        current_dir = os.path.join(UPLOAD_DIR, folder) if folder else UPLOAD_DIR
-        if not os.path.exists(current_dir):
-            raise HTTPException(status_code=404, detail="文件夹不存在")
-        
-        files = []
-        
-        # 遍历当前目录
-        for item_name in os.listdir(current_dir):
-            # 跳过元数据文件
-            if item_name.endswith('.meta') or item_name == '.folder_meta':
-                continue
-                
-            item_path = os.path.join(current_dir, item_name)
-            relative_path = os.path.join(folder, item_name) if folder else item_name
-            
-            # 获取文件信息
-            file_info = get_file_info(item_path, relative_path)
-            
-            # 搜索过滤
-            if search:
-                search_lower = search.lower()
-                # 在文件名、上传者和备注中搜索
-                comment = file_info.get("comment") or ""
-                if (search_lower not in file_info["name"].lower() and 
-                    search_lower not in file_info["uploader_username"].lower() and
-                    search_lower not in comment.lower()):
-                    continue
-            
-            files.append(file_info)
-        
-        # 排序
-        reverse = (sort_order == "desc")
-        if sort_by == "name":
-            # 文件夹排在前面，然后按名称排序
-            files.sort(key=lambda x: (x["type"] != "folder", x["name"]), reverse=reverse)
-        elif sort_by == "time":
-            files.sort(key=lambda x: x["created"], reverse=reverse)
-        elif sort_by == "uploader_ip":
-            files.sort(key=lambda x: x["uploader_ip"], reverse=reverse)
-        elif sort_by == "size":
-            files.sort(key=lambda x: x["size"], reverse=reverse)
+        # 第一项用于失效时按文件夹匹配
+        key = (normalize_relative_path(folder), folder, sort_by, sort_order, search, limit, cursor)
+        entry = listing_cache.get(key)
+        if entry is None:
+            generation = listing_cache.generation
+            listing = await run_io(build_files_listing, folder, sort_by, sort_order, search, limit, cursor)
+            body = json.dumps(listing, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            listing_cache.put(key, etag, body, generation)
+        else:
+            etag, body = entry
         
-        return {
-            "files": files,
-            "current_folder": folder,
-            "parent_folder": os.path.dirname(folder) if folder else None
-        }
+        # 浏览器每次都会带 If-None-Match 重新验证，未变化的文件夹返回304
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取文件列表失败: {str(e)}")
 
+# 全局搜索
+SEARCH_MAX_LIMIT = 200
+
+@app.get("/search")
+async def search_files(
+    q: str,
+    folder: str = "",  # 只搜索该文件夹及其子文件夹，默认搜索全部
+    limit: int = 50,
+    offset: int = 0
+):
+    """在所有文件夹中搜索文件和文件夹，结果按相关度排序并分页"""
+    if not q or not q.strip():
+        raise HTTPException(status_code=400, detail="搜索内容不能为空")
+    if limit <= 0 or limit > SEARCH_MAX_LIMIT or offset < 0:
+        raise HTTPException(status_code=400, detail=f"limit 必须在 1 到 {SEARCH_MAX_LIMIT} 之间")
+    try:
+        results, total = await run_io(file_index.search, q.strip(), folder, limit, offset)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
+    return {
+        "query": q,
+        "results": results,
+        "total": total,
+        "limit": limit,
+        "offset": offset
+    }
+
 @app.post("/folders")
 async def create_folder(
     folder_name: str = Form(...),
@@ -920,12 +3237,9 @@ async def create_folder(
         full_path = os.path.join(UPLOAD_DIR, folder_path)
         
         # 检查是否已存在
-        if os.path.exists(full_path):
+        if await run_io(os.path.exists, full_path):
             raise HTTPException(status_code=400, detail="文件夹已存在")
         
-        # 创建文件夹
-        os.makedirs(full_path)
-        
         # 获取创建者信息
         client_ip = get_real_client_ip(request=request)
         mapped_name = ip_vs_name.get(str(client_ip))
@@ -940,9 +3254,7 @@ async def create_folder(
             "type": "folder"
         }
         
-        metadata_path = os.path.join(full_path, ".folder_meta")
-        with open(metadata_path, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, ensure_ascii=False)
+        await run_io(create_folder_sync, folder_path, metadata)
         
         return {
             "message": "文件夹创建成功",
@@ -956,6 +3268,15 @@ async def create_folder(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"创建文件夹失败: {str(e)}")
 
+def create_folder_sync(folder_path: str, metadata: dict):
+    """创建文件夹和 .folder_meta 元数据，并更新索引"""
+    full_path = os.path.join(UPLOAD_DIR, folder_path)
+    os.makedirs(full_path)
+    metadata_path = os.path.join(full_path, ".folder_meta")
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False)
+    file_index.upsert(folder_path)
+
 @app.post("/move_file")
 async def move_file(
     file_name: str = Form(...),
@@ -965,91 +3286,96 @@ async def move_file(
 ):
     """移动文件到指定文件夹"""
     try:
-        # 构建源文件路径
-        if source_folder:
-            source_path = os.path.join(UPLOAD_DIR, source_folder, file_name)
-            source_meta_path = os.path.join(UPLOAD_DIR, source_folder, f"{file_name}.meta")
-        else:
-            source_path = os.path.join(UPLOAD_DIR, file_name)
-            source_meta_path = os.path.join(UPLOAD_DIR, f"{file_name}.meta")
-        
-        if not os.path.exists(source_path):
-            raise HTTPException(status_code=404, detail="源文件不存在")
-        
-        # 构建目标文件路径
-        if target_folder:
-            # 确保目标文件夹存在
-            ensure_folder_exists(target_folder)
-            target_path = os.path.join(UPLOAD_DIR, target_folder, file_name)
-            target_meta_path = os.path.join(UPLOAD_DIR, target_folder, f"{file_name}.meta")
-        else:
-            target_path = os.path.join(UPLOAD_DIR, file_name)
-            target_meta_path = os.path.join(UPLOAD_DIR, f"{file_name}.meta")
-        
-        # 检查目标位置是否已有同名文件
-        if os.path.exists(target_path):
-            raise HTTPException(status_code=400, detail="目标位置已存在同名文件")
-        
-        # 移动文件和元数据
-        os.rename(source_path, target_path)
-        if os.path.exists(source_meta_path):
-            os.rename(source_meta_path, target_meta_path)
-        
-        return {
-            "message": "文件移动成功",
-            "file_name": file_name,
-            "source_folder": source_folder,
-            "target_folder": target_folder
-        }
-        
+        return await run_io(move_file_sync, file_name, source_folder, target_folder)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"移动文件失败: {str(e)}")
 
+def move_file_sync(file_name: str, source_folder: str = "", target_folder: str = "") -> dict:
+    """移动文件和元数据，并更新索引"""
+    # 构建源文件路径
+    if source_folder:
+        source_path = os.path.join(UPLOAD_DIR, source_folder, file_name)
+        source_meta_path = os.path.join(UPLOAD_DIR, source_folder, f"{file_name}.meta")
+    else:
+        source_path = os.path.join(UPLOAD_DIR, file_name)
+        source_meta_path = os.path.join(UPLOAD_DIR, f"{file_name}.meta")
+    
+    if not os.path.exists(source_path):
+        raise HTTPException(status_code=404, detail="源文件不存在")
+    
+    # 构建目标文件路径
+    if target_folder:
+        # 确保目标文件夹存在
+        ensure_folder_exists(target_folder)
+        target_path = os.path.join(UPLOAD_DIR, target_folder, file_name)
+        target_meta_path = os.path.join(UPLOAD_DIR, target_folder, f"{file_name}.meta")
+    else:
+        target_path = os.path.join(UPLOAD_DIR, file_name)
+        target_meta_path = os.path.join(UPLOAD_DIR, f"{file_name}.meta")
+    
+    # 检查目标位置是否已有同名文件
+    if os.path.exists(target_path):
+        raise HTTPException(status_code=400, detail="目标位置已存在同名文件")
+    
+    # 移动文件和元数据
+    os.rename(source_path, target_path)
+    if os.path.exists(source_meta_path):
+        os.rename(source_meta_path, target_meta_path)
+    file_index.move(to_relative_path(source_path), to_relative_path(target_path))
+    
+    return {
+        "message": "文件移动成功",
+        "file_name": file_name,
+        "source_folder": source_folder,
+        "target_folder": target_folder
+    }
+
+def is_admin_request(request: Request, admin_session_id: str = None) -> bool:
+    """验证管理员权限 - 支持IP验证或admin session验证"""
+    client_ip = get_real_client_ip(request=request)
+    if client_ip == admin_ip:
+        return True
+    
+    # 检查admin session
+    if admin_session_id and admin_session_id in admin_sessions:
+        return True
+    
+    # 尝试从请求头获取admin session
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('AdminSession '):
+        session_id = auth_header.replace('AdminSession ', '')
+        if session_id in admin_sessions:
+            return True
+    return False
+
 @app.delete("/folders/{folder_path:path}")
 async def delete_folder(folder_path: str, request: Request = None, admin_session_id: str = None):
     """删除文件夹（包括其中的所有文件和子文件夹）- 仅管理员可操作"""
     try:
-        # 验证管理员权限 - 支持IP验证或admin session验证
-        client_ip = get_real_client_ip(request=request)
-        is_admin_by_ip = (client_ip == admin_ip)
-        
-        # 检查admin session
-        is_admin_by_session = False
-        if admin_session_id and admin_session_id in admin_sessions:
-            is_admin_by_session = True
-        
-        # 如果不是通过IP验证的管理员，尝试从请求头获取admin session
-        if not is_admin_by_ip and not is_admin_by_session:
-            auth_header = request.headers.get('Authorization')
-            if auth_header and auth_header.startswith('AdminSession '):
-                session_id = auth_header.replace('AdminSession ', '')
-                if session_id in admin_sessions:
-                    is_admin_by_session = True
-        
-        if not is_admin_by_ip and not is_admin_by_session:
+        if not is_admin_request(request, admin_session_id):
             raise HTTPException(status_code=403, detail="权限不足，只有管理员才能删除文件夹")
-        
-        full_path = os.path.join(UPLOAD_DIR, folder_path)
-        
-        if not os.path.exists(full_path):
-            raise HTTPException(status_code=404, detail="文件夹不存在")
-        
-        if not os.path.isdir(full_path):
-            raise HTTPException(status_code=400, detail="指定路径不是文件夹")
-        
-        # 删除文件夹及其所有内容
-        import shutil
-        shutil.rmtree(full_path)
-        
-        return {"message": "文件夹及其所有内容删除成功", "folder_path": folder_path}
+        return await run_io(delete_folder_sync, folder_path, get_real_client_ip(request=request))
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除文件夹失败: {str(e)}")
 
+def delete_folder_sync(folder_path: str, deleted_by: str = "") -> dict:
+    """把文件夹及其所有内容移到回收站，并更新索引"""
+    full_path = os.path.join(UPLOAD_DIR, folder_path)
+    
+    if not os.path.exists(full_path):
+        raise HTTPException(status_code=404, detail="文件夹不存在")
+    
+    if not os.path.isdir(full_path):
+        raise HTTPException(status_code=400, detail="指定路径不是文件夹")
+    
+    entry = move_to_trash(folder_path, deleted_by)
+    return {"message": "文件夹已移到回收站", "folder_path": folder_path, "trash_id": entry["id"]}
+
 @app.post("/rename_file")
 async def rename_file(
     old_name: str = Form(...),
@@ -1059,134 +3385,144 @@ async def rename_file(
 ):
     """重命名文件"""
     try:
-        # 验证新文件名 - 宽松版本
-        if not new_name or not new_name.strip():
-            raise HTTPException(status_code=400, detail="新文件名不能为空")
-        
-        new_name = new_name.strip()
-        # 自动修复文件名，替换有害字符
-        new_name = new_name.replace('/', '-').replace('\\', '-').replace('|', '_')
-        
-        # 只检查真正有害的字符
-        if '/' in new_name or '\\' in new_name:
-            raise HTTPException(status_code=400, detail="文件名包含不安全字符")
-        
-        # 构建文件路径
-        if folder_path:
-            old_file_path = os.path.join(UPLOAD_DIR, folder_path, old_name)
-            new_file_path = os.path.join(UPLOAD_DIR, folder_path, new_name)
-            old_meta_path = os.path.join(UPLOAD_DIR, folder_path, f"{old_name}.meta")
-            new_meta_path = os.path.join(UPLOAD_DIR, folder_path, f"{new_name}.meta")
-        else:
-            old_file_path = os.path.join(UPLOAD_DIR, old_name)
-            new_file_path = os.path.join(UPLOAD_DIR, new_name)
-            old_meta_path = os.path.join(UPLOAD_DIR, f"{old_name}.meta")
-            new_meta_path = os.path.join(UPLOAD_DIR, f"{new_name}.meta")
-        
-        # 检查原文件是否存在
-        if not os.path.exists(old_file_path):
-            raise HTTPException(status_code=404, detail="原文件不存在")
-        
-        # 检查新文件名是否已存在
-        if os.path.exists(new_file_path):
-            raise HTTPException(status_code=400, detail="新文件名已存在")
-        
-        # 重命名文件
-        os.rename(old_file_path, new_file_path)
-        
-        # 重命名元数据文件（如果存在）
-        if os.path.exists(old_meta_path):
-            os.rename(old_meta_path, new_meta_path)
-            
-            # 更新元数据中的原始文件名
-            try:
-                with open(new_meta_path, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-                metadata["original_name"] = new_name
-                with open(new_meta_path, "w", encoding="utf-8") as f:
-                    json.dump(metadata, f, ensure_ascii=False)
-            except:
-                pass  # 如果更新元数据失败，文件重命名仍然成功
-        
-        return {
-            "message": "文件重命名成功",
-            "old_name": old_name,
-            "new_name": new_name,
-            "folder_path": folder_path
-        }
-        
+        return await run_io(rename_file_sync, old_name, new_name, folder_path)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"重命名文件失败: {str(e)}")
 
+def rename_file_sync(old_name: str, new_name: str, folder_path: str = "") -> dict:
+    """重命名文件和元数据，并更新索引"""
+    # 验证新文件名 - 宽松版本
+    if not new_name or not new_name.strip():
+        raise HTTPException(status_code=400, detail="新文件名不能为空")
+    
+    new_name = new_name.strip()
+    # 自动修复文件名，替换有害字符
+    new_name = new_name.replace('/', '-').replace('\\', '-').replace('|', '_')
+    
+    # 只检查真正有害的字符
+    if '/' in new_name or '\\' in new_name:
+        raise HTTPException(status_code=400, detail="文件名包含不安全字符")
+    
+    # 构建文件路径
+    if folder_path:
+        old_file_path = os.path.join(UPLOAD_DIR, folder_path, old_name)
+        new_file_path = os.path.join(UPLOAD_DIR, folder_path, new_name)
+        old_meta_path = os.path.join(UPLOAD_DIR, folder_path, f"{old_name}.meta")
+        new_meta_path = os.path.join(UPLOAD_DIR, folder_path, f"{new_name}.meta")
+    else:
+        old_file_path = os.path.join(UPLOAD_DIR, old_name)
+        new_file_path = os.path.join(UPLOAD_DIR, new_name)
+        old_meta_path = os.path.join(UPLOAD_DIR, f"{old_name}.meta")
+        new_meta_path = os.path.join(UPLOAD_DIR, f"{new_name}.meta")
+    
+    # 检查原文件是否存在
+    if not os.path.exists(old_file_path):
+        raise HTTPException(status_code=404, detail="原文件不存在")
+    
+    # 检查新文件名是否已存在
+    if os.path.exists(new_file_path):
+        raise HTTPException(status_code=400, detail="新文件名已存在")
+    
+    # 重命名文件
+    os.rename(old_file_path, new_file_path)
+    
+    # 重命名元数据文件（如果存在）
+    if os.path.exists(old_meta_path):
+        os.rename(old_meta_path, new_meta_path)
+        
+        # 更新元数据中的原始文件名
+        try:
+            with open(new_meta_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            metadata["original_name"] = new_name
+            with open(new_meta_path, "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False)
+        except:
+            pass  # 如果更新元数据失败，文件重命名仍然成功
+    
+    file_index.move(to_relative_path(old_file_path), to_relative_path(new_file_path))
+    file_index.upsert(to_relative_path(new_file_path))
+    
+    return {
+        "message": "文件重命名成功",
+        "old_name": old_name,
+        "new_name": new_name,
+        "folder_path": folder_path
+    }
+
 @app.post("/rename_folder")
 async def rename_folder(
-    old_name: str = Form(...),
-    new_name: str = Form(...),
-    parent_folder: str = Form(""),
-    request: Request = None
-):
-    """重命名文件夹"""
-    try:
-        # 验证新文件夹名
-        if not new_name or not new_name.strip():
-            raise HTTPException(status_code=400, detail="新文件夹名不能为空")
-        
-        new_name = new_name.strip()
-        # 自动修复文件夹名称，替换有害字符
-        new_name = new_name.replace('/', '-').replace('\\', '-').replace('|', '_')
-        
-        # 只检查真正有害的字符
-        if '/' in new_name or '\\' in new_name:
-            raise HTTPException(status_code=400, detail="文件夹名包含不安全字符")
-        
-        # 构建文件夹路径
-        if parent_folder:
-            old_folder_path = os.path.join(UPLOAD_DIR, parent_folder, old_name)
-            new_folder_path = os.path.join(UPLOAD_DIR, parent_folder, new_name)
-        else:
-            old_folder_path = os.path.join(UPLOAD_DIR, old_name)
-            new_folder_path = os.path.join(UPLOAD_DIR, new_name)
-        
-        # 检查原文件夹是否存在
-        if not os.path.exists(old_folder_path):
-            raise HTTPException(status_code=404, detail="原文件夹不存在")
-        
-        if not os.path.isdir(old_folder_path):
-            raise HTTPException(status_code=400, detail="指定路径不是文件夹")
-        
-        # 检查新文件夹名是否已存在
-        if os.path.exists(new_folder_path):
-            raise HTTPException(status_code=400, detail="新文件夹名已存在")
-        
-        # 重命名文件夹
-        os.rename(old_folder_path, new_folder_path)
-        
-        # 更新文件夹元数据（如果存在）
-        meta_file = os.path.join(new_folder_path, ".folder_meta")
-        if os.path.exists(meta_file):
-            try:
-                with open(meta_file, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-                metadata["folder_name"] = new_name
-                with open(meta_file, "w", encoding="utf-8") as f:
-                    json.dump(metadata, f, ensure_ascii=False)
-            except:
-                pass  # 如果更新元数据失败，文件夹重命名仍然成功
-        
-        return {
-            "message": "文件夹重命名成功",
-            "old_name": old_name,
-            "new_name": new_name,
-            "parent_folder": parent_folder
-        }
-        
+    old_name: str = Form(...),
+    new_name: str = Form(...),
+    parent_folder: str = Form(""),
+    request: Request = None
+):
+    """重命名文件夹"""
+    try:
+        return await run_io(rename_folder_sync, old_name, new_name, parent_folder)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"重命名文件夹失败: {str(e)}")
 
+def rename_folder_sync(old_name: str, new_name: str, parent_folder: str = "") -> dict:
+    """重命名文件夹，并更新索引"""
+    # 验证新文件夹名
+    if not new_name or not new_name.strip():
+        raise HTTPException(status_code=400, detail="新文件夹名不能为空")
+    
+    new_name = new_name.strip()
+    # 自动修复文件夹名称，替换有害字符
+    new_name = new_name.replace('/', '-').replace('\\', '-').replace('|', '_')
+    
+    # 只检查真正有害的字符
+    if '/' in new_name or '\\' in new_name:
+        raise HTTPException(status_code=400, detail="文件夹名包含不安全字符")
+    
+    # 构建文件夹路径
+    if parent_folder:
+        old_folder_path = os.path.join(UPLOAD_DIR, parent_folder, old_name)
+        new_folder_path = os.path.join(UPLOAD_DIR, parent_folder, new_name)
+    else:
+        old_folder_path = os.path.join(UPLOAD_DIR, old_name)
+        new_folder_path = os.path.join(UPLOAD_DIR, new_name)
+    
+    # 检查原文件夹是否存在
+    if not os.path.exists(old_folder_path):
+        raise HTTPException(status_code=404, detail="原文件夹不存在")
+    
+    if not os.path.isdir(old_folder_path):
+        raise HTTPException(status_code=400, detail="指定路径不是文件夹")
+    
+    # 检查新文件夹名是否已存在
+    if os.path.exists(new_folder_path):
+        raise HTTPException(status_code=400, detail="新文件夹名已存在")
+    
+    # 重命名文件夹
+    os.rename(old_folder_path, new_folder_path)
+    file_index.move(to_relative_path(old_folder_path), to_relative_path(new_folder_path))
+    
+    # 更新文件夹元数据（如果存在）
+    meta_file = os.path.join(new_folder_path, ".folder_meta")
+    if os.path.exists(meta_file):
+        try:
+            with open(meta_file, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            metadata["folder_name"] = new_name
+            with open(meta_file, "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False)
+        except:
+            pass  # 如果更新元数据失败，文件夹重命名仍然成功
+    
+    return {
+        "message": "文件夹重命名成功",
+        "old_name": old_name,
+        "new_name": new_name,
+        "parent_folder": parent_folder
+    }
+
 # 修改 WebSocket 路由
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
@@ -1197,6 +3533,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
     
     user = active_users[session_id]
     await manager.connect(websocket, session_id)
+    outbox = manager.outboxes[session_id]
     
     # 更新用户最后在线时间
     user.last_seen = datetime.now()
@@ -1204,8 +3541,11 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
     print(f"User {user.username} connected via WebSocket")
     
     try:
-        while True:
+        while not outbox.closed:
             data = await websocket.receive_json()
+            # 连接已被移除（太慢被断开或发送失败），不再处理它发来的消息
+            if outbox.closed:
+                break
             print(f"Message from {user.username}: {data}")
             
             # 创建消息对象
@@ -1220,7 +3560,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                 # 检查目标用户是否在线
                 target_session = user_sessions.get(target_username)
                 if not target_session:
-                    await websocket.send_json({
+                    outbox.send_json({
                         "type": "error",
                         "message": f"用户 {target_username} 不在线"
                     })
@@ -1281,6 +3621,10 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             # 更新用户最后在线时间
             user.last_seen = now
             
+    except asyncio.CancelledError:
+        if not outbox.closed:
+            raise
+        print(f"慢连接 {user.username} 已断开")
     except Exception as e:
         print(f"WebSocket error for {user.username}: {e}")
     finally:
@@ -1290,47 +3634,365 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
 @app.get("/chat")
 async def chat_page(request: Request, auth: bool = Depends(conditional_auth)):
     """聊天页面 - 对127.0.0.1访问需要身份验证"""
-    with open("templates/chat.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    return HTMLResponse(content=html_content)
+    return HTMLResponse(content=await run_io(read_template, "templates/chat.html"))
+
+@app.get("/chat/history")
+async def get_chat_messages(request: Request, peer_ip: Optional[str] = None, before: Optional[float] = None,
+                            before_seq: Optional[int] = None, limit: int = 50):
+    """按需查询更早的聊天记录：不指定 peer_ip 为群聊，否则为当前IP与 peer_ip 的私聊
+    
+    before 为毫秒时间戳，返回该时间之前的 limit 条消息（按时间顺序）；
+    翻页时把上一页的 next_before 和 next_before_seq 一起传回，时间戳相同的消息不会被跳过
+    """
+    limit = max(1, min(limit, 500))
+    if peer_ip:
+        conversation = private_chat_key(get_real_client_ip(request=request), peer_ip)
+    else:
+        conversation = GROUP_CONVERSATION
+    # 先提交待写入的消息，保证查询结果包含刚发送的消息
+    await chat_store.flush()
+    messages = await run_io(chat_store.query, conversation, before, limit, before_seq)
+    return {
+        "messages": messages,
+        "has_more": len(messages) == limit,
+        "next_before": message_timestamp(messages[0]) if messages else None,
+        "next_before_seq": messages[0].get("seq") if messages else None
+    }
+
+@app.get("/chat/conversations")
+async def get_chat_conversations(request: Request):
+    """当前IP参与的私聊会话，最近有消息的在前"""
+    client_ip = get_real_client_ip(request=request)
+    await chat_store.flush()
+    conversations = await run_io(chat_store.conversations_for, client_ip)
+    return {
+        "conversations": [
+            {
+                "peer_ip": next((ip for ip in conversation["conversation"].split("_") if ip != client_ip), client_ip),
+                "last_timestamp": conversation["last_timestamp"]
+            }
+            for conversation in conversations
+        ]
+    }
 
 @app.get("/test")
 async def test_chat_page(request: Request, auth: bool = Depends(conditional_auth)):
     """测试聊天页面 - 对127.0.0.1访问需要身份验证"""
-    with open("test_chat.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    return HTMLResponse(content=html_content)
+    return HTMLResponse(content=await run_io(read_template, "test_chat.html"))
 
-@app.get("/download/{file_path:path}")
-async def download_file(file_path: str):
-    """强制下载文件，而不是在浏览器中显示，支持文件夹路径"""
-    try:
-        full_file_path = os.path.join(UPLOAD_DIR, file_path)
-        
-        if not os.path.exists(full_file_path):
-            raise HTTPException(status_code=404, detail="文件不存在")
-        
-        if os.path.isdir(full_file_path):
-            raise HTTPException(status_code=400, detail="无法下载文件夹")
-        
-        # 读取文件元数据获取原始文件名
-        metadata_path = full_file_path + ".meta"
-        original_name = os.path.basename(file_path)  # 默认使用当前文件名
-        
-        if os.path.exists(metadata_path):
+# 文件响应：支持 Range（单区间/多区间）、ETag 和条件请求，
+# 断点下载、视频拖动和重复预览只传输真正需要的字节
+FILE_RESPONSE_CHUNK_SIZE = 1024 * 1024
+MAX_RANGES_PER_REQUEST = 32
+
+def attachment_disposition(download_name: str) -> str:
+    """生成附件下载的 Content-Disposition 头"""
+    if download_name.isascii():
+        return f'attachment; filename="{download_name}"'
+    return f"attachment; filename*=utf-8''{quote(download_name)}"
+
+def file_etag(file_path: str, stat_result: os.stat_result) -> str:
+    """生成强ETag：索引中记录的内容哈希仍然有效时使用哈希，否则使用修改时间和大小
+    
+    会查询文件索引（索引锁可能被对账等长事务持有），只在I/O线程中调用
+    """
+    row = file_index.get(to_relative_path(file_path))
+    if (row is not None and row["sha256"]
+            and row["size"] == stat_result.st_size and row["mtime_ns"] == stat_result.st_mtime_ns):
+        return f'"{row["sha256"]}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def etag_matches(header_value: str, etag: str, weak: bool = True) -> bool:
+    """判断 If-None-Match / If-Range 中的ETag列表是否匹配"""
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def parse_range_header(range_header: str, file_size: int):
+    """解析 Range 头，返回 [(start, end)] (end 包含在内)；格式不支持时返回 None，无法满足时返回空列表"""
+    unit, _, ranges_spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not ranges_spec:
+        return None
+    
+    ranges = []
+    for part in ranges_spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start_str, sep, end_str = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if start_str == "":
+                # 后缀区间：最后 N 个字节
+                suffix_length = int(end_str)
+                if suffix_length <= 0:
+                    continue
+                start = max(0, file_size - suffix_length)
+                end = file_size - 1
+            else:
+                start = int(start_str)
+                if end_str:
+                    end = int(end_str)
+                    if start > end:
+                        return None
+                    end = min(end, file_size - 1)
+                else:
+                    end = file_size - 1
+        except ValueError:
+            return None
+        if start < file_size:
+            ranges.append((start, end))
+    
+    if len(ranges) > MAX_RANGES_PER_REQUEST:
+        return None
+    return ranges
+
+async def iter_file_range(file_path: str, start: int, end: int):
+    """异步读取文件的 [start, end] 区间"""
+    remaining = end - start + 1
+    async with aiofiles.open(file_path, "rb", executor=io_executor) as f:
+        await f.seek(start)
+        while remaining > 0:
+            chunk = await f.read(min(FILE_RESPONSE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def build_file_response(
+    request: Request,
+    file_path: str,
+    media_type: str,
+    download_name: Optional[str] = None
+) -> Response:
+    """根据请求头返回完整文件、206部分内容、304未修改或416（stat和ETag查询都是阻塞操作，通过 run_io 调用）"""
+    stat_result = os.stat(file_path)
+    file_size = stat_result.st_size
+    etag = file_etag(file_path, stat_result)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified
+    }
+    if download_name:
+        headers["Content-Disposition"] = attachment_disposition(download_name)
+    
+    # 条件请求：If-None-Match 优先，其次 If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
             try:
-                with open(metadata_path, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-                    original_name = metadata.get("original_name", original_name)
-            except:
-                pass  # 如果读取元数据失败，使用默认文件名
-        
-        return FileResponse(
-            path=full_file_path,
-            filename=original_name,
-            media_type='application/octet-stream'  # 强制下载
+                if int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp():
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+    
+    is_head = request.method == "HEAD"
+    ranges = None
+    range_header = request.headers.get("range")
+    if range_header:
+        # If-Range 不匹配时说明客户端缓存的版本已过期，返回完整文件
+        if_range = request.headers.get("if-range")
+        if if_range is None or (
+            etag_matches(if_range, etag, weak=False) if if_range.strip().startswith(('"', 'W/'))
+            else if_range.strip() == last_modified
+        ):
+            ranges = parse_range_header(range_header, file_size)
+    
+    if ranges is not None and not ranges:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(status_code=416, headers=headers)
+    
+    if not ranges:
+        headers["Content-Length"] = str(file_size)
+        if is_head:
+            return Response(status_code=200, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            iter_file_range(file_path, 0, file_size - 1),
+            status_code=200, headers=headers, media_type=media_type
         )
-        
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        if is_head:
+            return Response(status_code=206, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            iter_file_range(file_path, start, end),
+            status_code=206, headers=headers, media_type=media_type
+        )
+    
+    # 多区间：multipart/byteranges
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (
+            f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+        ).encode("latin-1")
+        for start, end in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    content_length = sum(len(h) for h in part_headers) + len(closing)
+    content_length += sum(end - start + 1 for start, end in ranges) + 2 * (len(ranges) - 1)
+    headers["Content-Length"] = str(content_length)
+    multipart_type = f"multipart/byteranges; boundary={boundary}"
+    if is_head:
+        return Response(status_code=206, headers=headers, media_type=multipart_type)
+    
+    async def iter_multipart():
+        for index, ((start, end), part_header) in enumerate(zip(ranges, part_headers)):
+            if index:
+                yield b"\r\n"
+            yield part_header
+            async for chunk in iter_file_range(file_path, start, end):
+                yield chunk
+        yield closing
+    
+    return StreamingResponse(iter_multipart(), status_code=206, headers=headers, media_type=multipart_type)
+
+# 文件夹打包下载：边读边输出ZIP，不在磁盘上生成临时压缩包，内存占用固定
+class ZipStreamBuffer:
+    """zipfile 的只写输出目标，写入的数据由生成器取走后立即释放"""
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def unique_archive_name(arcname: str, used_names: set) -> str:
+    """同一目录下原始文件名重复时添加序号"""
+    candidate = arcname
+    base, ext = os.path.splitext(arcname)
+    counter = 1
+    while candidate in used_names:
+        candidate = f"{base} ({counter}){ext}"
+        counter += 1
+    used_names.add(candidate)
+    return candidate
+
+def iter_folder_zip(folder_path: str):
+    """逐个成员生成文件夹的ZIP数据流（ZIP64，不压缩，适合局域网传输大文件）"""
+    buffer = ZipStreamBuffer()
+    used_names = set()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for current_dir, dir_names, file_names in os.walk(folder_path):
+            # 跳过内部目录，并保证输出顺序稳定
+            dir_names[:] = sorted(d for d in dir_names if not is_hidden_entry(d))
+            relative_dir = os.path.relpath(current_dir, folder_path)
+            relative_dir = "" if relative_dir == "." else relative_dir.replace(os.sep, "/") + "/"
+            
+            visible_files = sorted(f for f in file_names if not is_hidden_entry(f))
+            if relative_dir and not visible_files and not dir_names:
+                # 保留空文件夹
+                zf.writestr(zipfile.ZipInfo(relative_dir), b"")
+                yield buffer.pop()
+                continue
+            
+            for file_name in visible_files:
+                file_path = os.path.join(current_dir, file_name)
+                if not os.path.isfile(file_path):
+                    continue
+                row = file_index.get(to_relative_path(file_path))
+                original_name = (row["original_name"] if row is not None else None) or file_name
+                arcname = unique_archive_name(relative_dir + os.path.basename(original_name), used_names)
+                
+                zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with open(file_path, "rb") as src, zf.open(zinfo, "w", force_zip64=True) as dest:
+                    while chunk := src.read(FILE_RESPONSE_CHUNK_SIZE):
+                        dest.write(chunk)
+                        yield buffer.pop()
+                yield buffer.pop()
+    # 关闭时写入中央目录
+    yield buffer.pop()
+
+def resolve_upload_file(file_path: str) -> str:
+    """把URL中的相对路径转换为UPLOAD_DIR下的真实路径，拒绝越出上传目录的路径
+    和内部条目（回收站、数据块、未完成的上传、.meta 等）"""
+    upload_root = os.path.realpath(UPLOAD_DIR)
+    full_path = os.path.realpath(os.path.join(UPLOAD_DIR, file_path))
+    if full_path != upload_root and not full_path.startswith(upload_root + os.sep):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    if full_path != upload_root and any(
+        is_hidden_entry(part) for part in os.path.relpath(full_path, upload_root).split(os.sep)
+    ):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return full_path
+
+def serve_upload_sync(request: Request, file_path: str) -> Response:
+    """预览响应：路径解析、stat 和ETag查询都在I/O线程中完成"""
+    full_file_path = resolve_upload_file(file_path)
+    if not os.path.isfile(full_file_path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    media_type = mimetypes.guess_type(full_file_path)[0] or "application/octet-stream"
+    return build_file_response(request, full_file_path, media_type)
+
+def download_file_sync(request: Request, file_path: str) -> Response:
+    """下载响应：路径解析、stat、索引和ETag查询都在I/O线程中完成"""
+    full_file_path = resolve_upload_file(file_path)
+    
+    # 不允许把整个上传目录打包下载（空路径、"." 或 "sub/.." 都会解析到根目录）
+    if full_file_path == os.path.realpath(UPLOAD_DIR) or not os.path.exists(full_file_path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    
+    if os.path.isdir(full_file_path):
+        # 文件夹打包为ZIP流式下载
+        folder_name = os.path.basename(full_file_path.rstrip(os.sep))
+        headers = {"Content-Disposition": attachment_disposition(f"{folder_name}.zip")}
+        if request.method == "HEAD":
+            return Response(status_code=200, headers=headers, media_type="application/zip")
+        return StreamingResponse(
+            iter_folder_zip(full_file_path),
+            headers=headers,
+            media_type="application/zip"
+        )
+    
+    # 读取文件元数据获取原始文件名
+    row = file_index.get(to_relative_path(full_file_path))
+    original_name = (row["original_name"] if row is not None else None) or os.path.basename(full_file_path)
+    
+    return build_file_response(
+        request,
+        full_file_path,
+        'application/octet-stream',  # 强制下载
+        download_name=original_name
+    )
+
+@app.api_route("/uploads/{file_path:path}", methods=["GET", "HEAD"])
+async def serve_upload(file_path: str, request: Request):
+    """在浏览器中直接访问上传的文件（图片/视频预览），支持Range和缓存验证"""
+    return await run_io(serve_upload_sync, request, file_path)
+
+@app.api_route("/download/{file_path:path}", methods=["GET", "HEAD"])
+async def download_file(file_path: str, request: Request):
+    """强制下载文件，而不是在浏览器中显示，支持断点续传；文件夹会打包为ZIP下载"""
+    try:
+        return await run_io(download_file_sync, request, file_path)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"下载失败: {str(e)}")
 
@@ -1338,45 +4000,852 @@ async def download_file(file_path: str):
 async def delete_file(file_path: str, request: Request = None, admin_session_id: str = None):
     """删除文件，支持文件夹路径 - 仅管理员可操作"""
     try:
-        # 验证管理员权限 - 支持IP验证或admin session验证
-        client_ip = get_real_client_ip(request=request)
-        is_admin_by_ip = (client_ip == admin_ip)
-        
-        # 检查admin session
-        is_admin_by_session = False
-        if admin_session_id and admin_session_id in admin_sessions:
-            is_admin_by_session = True
-        
-        # 如果不是通过IP验证的管理员，尝试从请求头获取admin session
-        if not is_admin_by_ip and not is_admin_by_session:
-            auth_header = request.headers.get('Authorization')
-            if auth_header and auth_header.startswith('AdminSession '):
-                session_id = auth_header.replace('AdminSession ', '')
-                if session_id in admin_sessions:
-                    is_admin_by_session = True
-        
-        if not is_admin_by_ip and not is_admin_by_session:
+        if not is_admin_request(request, admin_session_id):
             raise HTTPException(status_code=403, detail="权限不足，只有管理员才能删除文件")
-        
-        full_file_path = os.path.join(UPLOAD_DIR, file_path)
-        metadata_path = full_file_path + ".meta"
-        
-        if not os.path.exists(full_file_path):
-            raise HTTPException(status_code=404, detail="文件不存在")
-        
-        if os.path.isdir(full_file_path):
-            raise HTTPException(status_code=400, detail="请使用文件夹删除接口")
-        
-        if os.path.exists(full_file_path):
-            os.remove(full_file_path)
-        if os.path.exists(metadata_path):
-            os.remove(metadata_path)
-        return {"message": "文件删除成功"}
+        return await run_io(delete_file_sync, file_path, get_real_client_ip(request=request))
     except HTTPException:
         raise
     except Exception as e:
         return {"message": f"删除失败: {str(e)}"}
 
+def delete_file_sync(file_path: str, deleted_by: str = "") -> dict:
+    """把文件和元数据移到回收站，并更新索引"""
+    full_file_path = os.path.join(UPLOAD_DIR, file_path)
+    
+    if not os.path.exists(full_file_path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    
+    if os.path.isdir(full_file_path):
+        raise HTTPException(status_code=400, detail="请使用文件夹删除接口")
+    
+    entry = move_to_trash(file_path, deleted_by)
+    return {"message": "文件已移到回收站", "trash_id": entry["id"]}
+
+# 回收站：删除是同一文件系统内的一次重命名，耗时与文件数量无关。
+# 每个条目是 .trash/<id>/ 目录（内含被删除的文件或文件夹）加上记录原路径的 .trash/<id>.json；
+# 超过保留期或被手动清空的条目由 TrashPurger 在后台限速删除，删除后再回收无引用的数据块
+TRASH_RETENTION_SECONDS = int(float(os.environ.get("TRASH_RETENTION_DAYS", "7")) * 24 * 3600)
+TRASH_PURGE_INTERVAL = 3600  # 检查过期条目的间隔（秒）
+TRASH_PURGE_RATE = int(os.environ.get("TRASH_PURGE_RATE", "1000"))  # 每秒最多删除的文件数
+TRASH_PURGE_BATCH = max(1, TRASH_PURGE_RATE // 10)  # 每批删除后暂停 0.1 秒
+trash_lock = threading.Lock()  # 保护回收站记录的状态变化（移入、恢复、标记清理）
+
+def trash_record_path(trash_id: str) -> str:
+    if len(trash_id) != 32 or any(c not in "0123456789abcdef" for c in trash_id):
+        raise HTTPException(status_code=404, detail="回收站中没有该条目")
+    return os.path.join(TRASH_DIR, trash_id + ".json")
+
+def read_trash_record(trash_id: str) -> dict:
+    try:
+        with open(trash_record_path(trash_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise HTTPException(status_code=404, detail="回收站中没有该条目")
+
+def write_trash_record(entry: dict):
+    record_path = trash_record_path(entry["id"])
+    tmp_path = record_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, record_path)
+
+def move_to_trash(relative_path: str, deleted_by: str = "") -> dict:
+    """把文件或文件夹（连同 .meta）重命名到回收站，返回回收站记录"""
+    relative_path = normalize_relative_path(relative_path)
+    parts = relative_path.split("/")
+    if not relative_path or any(p == ".." or is_hidden_entry(p) for p in parts):
+        raise HTTPException(status_code=400, detail="无效的路径")
+    full_path = os.path.join(UPLOAD_DIR, relative_path)
+    is_folder = os.path.isdir(full_path)
+    row = file_index.get(relative_path)
+    entry = {
+        "id": uuid.uuid4().hex,
+        "original_path": relative_path,
+        "name": parts[-1],
+        "type": "folder" if is_folder else "file",
+        "size": row["size"] if row is not None else 0,
+        "file_count": (row["file_count"] if row is not None else 0) if is_folder else 1,
+        "deleted_at": time.time(),
+        "deleted_by": deleted_by,
+        "status": "trashed"
+    }
+    entry_dir = os.path.join(TRASH_DIR, entry["id"])
+    with trash_lock:
+        os.makedirs(entry_dir)
+        try:
+            os.rename(full_path, os.path.join(entry_dir, entry["name"]))
+        except OSError:
+            os.rmdir(entry_dir)
+            raise
+        if not is_folder and os.path.exists(full_path + ".meta"):
+            os.rename(full_path + ".meta", os.path.join(entry_dir, entry["name"] + ".meta"))
+        write_trash_record(entry)
+    file_index.remove(relative_path)
+    print(f"已移到回收站: {relative_path} ({entry['id']})")
+    return entry
+
+def trash_entry_to_public(entry: dict) -> dict:
+    return {
+        **entry,
+        "deleted_at": format_timestamp(entry["deleted_at"]),
+        "expires_at": format_timestamp(entry["deleted_at"] + TRASH_RETENTION_SECONDS)
+    }
+
+def list_trash_entries() -> List[dict]:
+    """回收站中的条目，最近删除的在前"""
+    entries = []
+    for name in os.listdir(TRASH_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            entries.append(read_trash_record(name[:-len(".json")]))
+        except HTTPException:
+            continue
+    entries.sort(key=lambda entry: entry["deleted_at"], reverse=True)
+    return entries
+
+def restore_from_trash(trash_id: str) -> dict:
+    """把条目移回原路径（原路径的上级文件夹已不存在时重新创建）"""
+    with trash_lock:
+        entry = read_trash_record(trash_id)
+        if entry["status"] != "trashed":
+            raise HTTPException(status_code=409, detail="该条目正在被清理，无法恢复")
+        entry_dir = os.path.join(TRASH_DIR, trash_id)
+        item_path = os.path.join(entry_dir, entry["name"])
+        if not os.path.lexists(item_path):
+            raise HTTPException(status_code=404, detail="回收站中的文件已丢失")
+        target_path = os.path.join(UPLOAD_DIR, entry["original_path"])
+        if os.path.lexists(target_path):
+            raise HTTPException(status_code=409, detail="原位置已存在同名文件或文件夹")
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.rename(item_path, target_path)
+        if os.path.exists(item_path + ".meta"):
+            os.rename(item_path + ".meta", target_path + ".meta")
+        os.rmdir(entry_dir)
+        os.remove(trash_record_path(trash_id))
+    file_index.upsert(entry["original_path"])
+    if entry["type"] == "folder":
+        file_index.reconcile(entry["original_path"])
+    print(f"已从回收站恢复: {entry['original_path']} ({trash_id})")
+    return entry
+
+def mark_trash_for_purge(trash_id: Optional[str] = None) -> int:
+    """标记条目立即清理（不指定ID时清空整个回收站），返回标记的条目数"""
+    with trash_lock:
+        entries = [read_trash_record(trash_id)] if trash_id else list_trash_entries()
+        for entry in entries:
+            entry["status"] = "purging"
+            write_trash_record(entry)
+    return len(entries)
+
+def claim_due_trash_entries() -> List[str]:
+    """找出需要清理的条目并标记为清理中（之后不能再恢复），返回它们的ID"""
+    due = []
+    now = time.time()
+    with trash_lock:
+        for name in os.listdir(TRASH_DIR):
+            if name.endswith(".json"):
+                try:
+                    entry = read_trash_record(name[:-len(".json")])
+                except HTTPException:
+                    continue
+                if entry["status"] == "purging" or now - entry["deleted_at"] >= TRASH_RETENTION_SECONDS:
+                    if entry["status"] != "purging":
+                        entry["status"] = "purging"
+                        write_trash_record(entry)
+                    due.append(entry["id"])
+            elif os.path.isdir(os.path.join(TRASH_DIR, name)) and not os.path.exists(os.path.join(TRASH_DIR, name + ".json")):
+                # 没有记录的目录（移入过程中服务中断）直接清理
+                due.append(name)
+    return due
+
+def iter_trash_entry_paths(entry_dir: str):
+    """自底向上列出条目中需要删除的路径，最后是条目目录本身"""
+    for current_dir, dir_names, file_names in os.walk(entry_dir, topdown=False):
+        for name in file_names + dir_names:
+            yield os.path.join(current_dir, name)
+    yield entry_dir
+
+def remove_trash_paths(paths, limit: int) -> tuple:
+    """从迭代器中最多删除 limit 个路径，返回 (删除数量, 是否已全部删除)"""
+    removed = 0
+    for path in paths:
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        removed += 1
+        if removed >= limit:
+            return removed, False
+    return removed, True
+
+class TrashPurger:
+    """后台清理回收站，按 TRASH_PURGE_RATE 限速删除，避免占满磁盘I/O影响上传和下载"""
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+    
+    def request_purge(self):
+        """有条目被标记为立即清理时唤醒清理任务"""
+        self.wakeup.set()
+    
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.purge_due()
+            except Exception as e:
+                print(f"清理回收站失败: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), TRASH_PURGE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def purge_due(self):
+        trash_ids = await run_io(claim_due_trash_entries)
+        for trash_id in trash_ids:
+            removed = await self._purge_entry(trash_id)
+            print(f"回收站条目已清理: {trash_id}, 删除 {removed} 项")
+        if trash_ids:
+            await run_io(gc_orphan_blobs)
+    
+    async def _purge_entry(self, trash_id: str) -> int:
+        # 先删除内容，最后删除记录：中途重启时记录仍是清理中，下次继续
+        paths = iter_trash_entry_paths(os.path.join(TRASH_DIR, trash_id))
+        total = 0
+        while True:
+            removed, finished = await run_io(remove_trash_paths, paths, TRASH_PURGE_BATCH)
+            total += removed
+            if finished:
+                break
+            await asyncio.sleep(0.1)
+        await run_io(remove_if_exists, os.path.join(TRASH_DIR, trash_id + ".json"))
+        return total
+
+trash_purger = TrashPurger()
+
+@app.get("/trash")
+async def list_trash(request: Request, admin_session_id: str = None):
+    """回收站中的条目 - 仅管理员可查看"""
+    if not is_admin_request(request, admin_session_id):
+        raise HTTPException(status_code=403, detail="权限不足，只有管理员才能查看回收站")
+    entries = await run_io(list_trash_entries)
+    return {
+        "entries": [trash_entry_to_public(entry) for entry in entries],
+        "retention_days": TRASH_RETENTION_SECONDS / (24 * 3600)
+    }
+
+@app.post("/trash/{trash_id}/restore")
+async def restore_trash(trash_id: str, request: Request, admin_session_id: str = None):
+    """把条目恢复到原路径 - 仅管理员可操作"""
+    if not is_admin_request(request, admin_session_id):
+        raise HTTPException(status_code=403, detail="权限不足，只有管理员才能恢复文件")
+    entry = await run_io(restore_from_trash, trash_id)
+    return {"message": "恢复成功", "path": entry["original_path"], "type": entry["type"]}
+
+@app.delete("/trash/{trash_id}")
+async def purge_trash(trash_id: str, request: Request, admin_session_id: str = None):
+    """立即彻底删除一个条目（在后台执行）- 仅管理员可操作"""
+    if not is_admin_request(request, admin_session_id):
+        raise HTTPException(status_code=403, detail="权限不足，只有管理员才能清理回收站")
+    await run_io(mark_trash_for_purge, trash_id)
+    trash_purger.request_purge()
+    return {"message": "已开始彻底删除"}
+
+@app.delete("/trash")
+async def empty_trash(request: Request, admin_session_id: str = None):
+    """清空回收站（在后台执行）- 仅管理员可操作"""
+    if not is_admin_request(request, admin_session_id):
+        raise HTTPException(status_code=403, detail="权限不足，只有管理员才能清理回收站")
+    count = await run_io(mark_trash_for_purge)
+    trash_purger.request_purge()
+    return {"message": "已开始清空回收站", "count": count}
+
+# 批量文件操作
+BATCH_MAX_OPERATIONS = 1000
+BATCH_ADMIN_OPERATIONS = {"delete", "delete_folder"}
+
+def run_batch_operation(operation: dict, deleted_by: str = "") -> dict:
+    """执行一项批量操作，参数与对应的单项接口相同；deleted_by 记录为回收站条目的删除者"""
+    op = operation.get("op")
+    try:
+        if op == "move":
+            return move_file_sync(
+                operation["file_name"], operation.get("source_folder", ""), operation.get("target_folder", "")
+            )
+        if op == "rename_file":
+            return rename_file_sync(operation["old_name"], operation["new_name"], operation.get("folder_path", ""))
+        if op == "rename_folder":
+            return rename_folder_sync(operation["old_name"], operation["new_name"], operation.get("parent_folder", ""))
+        if op == "delete":
+            return delete_file_sync(operation["file_path"], deleted_by)
+        if op == "delete_folder":
+            return delete_folder_sync(operation["folder_path"], deleted_by)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"缺少参数: {e.args[0]}")
+    raise HTTPException(status_code=400, detail=f"不支持的操作: {op}")
+
+def run_batch_operations(operations: List[dict], deleted_by: str = "") -> List[dict]:
+    """按顺序执行所有操作，单项失败不影响其他项"""
+    results = []
+    with defer_file_change_notifications():
+        for index, operation in enumerate(operations):
+            result = {"index": index, "op": operation.get("op")}
+            try:
+                result["result"] = run_batch_operation(operation, deleted_by)
+                result["success"] = True
+            except HTTPException as e:
+                result.update({"success": False, "status_code": e.status_code, "error": e.detail})
+            except Exception as e:
+                result.update({"success": False, "status_code": 500, "error": str(e)})
+            results.append(result)
+    return results
+
+@app.post("/batch")
+async def batch_file_operations(request: Request, admin_session_id: str = None):
+    """批量移动、重命名和删除，一次请求完成，返回每一项的结果
+    
+    请求体: {"operations": [{"op": "move", "file_name": ..., "source_folder": ..., "target_folder": ...},
+                            {"op": "rename_file", "old_name": ..., "new_name": ..., "folder_path": ...},
+                            {"op": "rename_folder", "old_name": ..., "new_name": ..., "parent_folder": ...},
+                            {"op": "delete", "file_path": ...},
+                            {"op": "delete_folder", "folder_path": ...}]}
+    """
+    try:
+        payload = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="请求体必须是JSON")
+    operations = payload.get("operations") if isinstance(payload, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise HTTPException(status_code=400, detail="operations 必须是非空列表")
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"一次最多 {BATCH_MAX_OPERATIONS} 项操作")
+    if not all(isinstance(operation, dict) for operation in operations):
+        raise HTTPException(status_code=400, detail="每项操作必须是JSON对象")
+    
+    # 整个批次只检查一次权限，包含删除操作时需要管理员
+    if any(operation.get("op") in BATCH_ADMIN_OPERATIONS for operation in operations):
+        if not is_admin_request(request, admin_session_id or payload.get("admin_session_id")):
+            raise HTTPException(status_code=403, detail="权限不足，只有管理员才能删除文件或文件夹")
+    
+    results = await run_io(run_batch_operations, operations, get_real_client_ip(request=request))
+    succeeded = sum(1 for result in results if result["success"])
+    return {
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded
+    }
+
+# 后台任务：删除大文件夹、打包ZIP、计算哈希和批量操作可能需要几分钟，
+# 超过 nginx 的 proxy_read_timeout（60秒）。提交后立即返回任务ID，
+# 通过 GET /jobs/{job_id} 轮询或在 /ws 上发送 job_subscribe 订阅进度
+JOBS_DB = os.path.join("database", "jobs.db")
+JOB_OUTPUT_DIR = os.path.join(UPLOAD_DIR, ".jobs")  # ZIP等任务的输出文件
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_PROGRESS_INTERVAL = 0.5  # 进度保存和推送的最小间隔（秒）
+JOB_RETENTION_SECONDS = 7 * 24 * 3600  # 已结束的任务保留7天
+JOB_FINISHED_STATUSES = ("completed", "failed", "cancelled")
+if not os.path.exists(JOB_OUTPUT_DIR):
+    os.makedirs(JOB_OUTPUT_DIR)
+
+class JobCancelled(Exception):
+    """任务被取消或服务关闭时在任务线程中抛出"""
+
+class JobContext:
+    """任务执行时用于报告进度和检查取消"""
+    def __init__(self, engine: "JobEngine", job: dict):
+        self.engine = engine
+        self.job = job
+        self.last_report = 0.0
+    
+    @property
+    def job_id(self) -> str:
+        return self.job["id"]
+    
+    def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None,
+                 state: Optional[dict] = None, force: bool = False):
+        """更新进度，按间隔保存并推送给订阅者；state 是任务恢复时需要的中间结果"""
+        self.job["progress_done"] = done
+        if total is not None:
+            self.job["progress_total"] = total
+        if message is not None:
+            self.job["message"] = message
+        if state is not None:
+            self.job["result"] = state
+        now = time.monotonic()
+        if force or now - self.last_report >= JOB_PROGRESS_INTERVAL:
+            self.last_report = now
+            self.engine.save(self.job)
+            self.engine.publish_threadsafe(self.job)
+    
+    def check_cancelled(self):
+        if self.engine.stopping or self.job_id in self.engine.cancel_requested:
+            raise JobCancelled()
+
+class JobEngine:
+    """持久化的后台任务队列，在有界的线程池中执行"""
+    def __init__(self, db_path: str, workers: int):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress_done INTEGER NOT NULL DEFAULT 0,
+                    progress_total INTEGER NOT NULL DEFAULT 0,
+                    message TEXT,
+                    result TEXT,
+                    error TEXT,
+                    submitted_by TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at)")
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.queue: Optional[asyncio.Queue] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.runners: List[asyncio.Task] = []
+        self.cancel_requested = set()
+        self.stopping = False
+        self.subscribers: Dict[str, set] = defaultdict(set)  # job_id -> 订阅连接的发送队列
+    
+    # 持久化
+    @staticmethod
+    def _from_row(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+    
+    def save(self, job: dict):
+        job["updated_at"] = datetime.now().timestamp()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO jobs (id, kind, params, status, progress_done, progress_total, message,
+                                     result, error, submitted_by, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET status = excluded.status,
+                       progress_done = excluded.progress_done, progress_total = excluded.progress_total,
+                       message = excluded.message, result = excluded.result, error = excluded.error,
+                       updated_at = excluded.updated_at""",
+                (job["id"], job["kind"], json.dumps(job["params"], ensure_ascii=False), job["status"],
+                 job["progress_done"], job["progress_total"], job["message"],
+                 json.dumps(job["result"], ensure_ascii=False) if job["result"] is not None else None,
+                 job["error"], job["submitted_by"], job["created_at"], job["updated_at"])
+            )
+    
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._from_row(row) if row is not None else None
+    
+    def list_recent(self, limit: int) -> List[dict]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._from_row(row) for row in rows]
+    
+    @staticmethod
+    def to_public(job: dict) -> dict:
+        """转换为接口返回的格式"""
+        return {
+            "job_id": job["id"],
+            "kind": job["kind"],
+            "params": job["params"],
+            "status": job["status"],
+            "progress": {"done": job["progress_done"], "total": job["progress_total"]},
+            "message": job["message"],
+            "result": job["result"] if job["status"] == "completed" else None,
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "updated_at": job["updated_at"]
+        }
+    
+    # 生命周期
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.stopping = False
+        self.cleanup_expired()
+        
+        # 重启前未完成的任务重新排队（任务实现保证可以重复执行）
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('pending', 'running') ORDER BY created_at"
+            ).fetchall()
+        for row in rows:
+            job = self.get(row["id"])
+            job["status"] = "pending"
+            self.save(job)
+            self.queue.put_nowait(job["id"])
+        if rows:
+            print(f"恢复未完成的后台任务: {len(rows)} 个")
+        
+        self.runners = [asyncio.create_task(self._runner()) for _ in range(self.workers)]
+    
+    def stop(self):
+        """关闭时让运行中的任务尽快退出，状态保持为 running，下次启动时恢复"""
+        self.stopping = True
+        for runner in self.runners:
+            runner.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    def cleanup_expired(self):
+        cutoff = datetime.now().timestamp() - JOB_RETENTION_SECONDS
+        with self.lock, self.conn:
+            expired = [row["id"] for row in self.conn.execute(
+                f"SELECT id FROM jobs WHERE status IN {JOB_FINISHED_STATUSES} AND updated_at < ?", (cutoff,)
+            )]
+            self.conn.execute(
+                f"DELETE FROM jobs WHERE status IN {JOB_FINISHED_STATUSES} AND updated_at < ?", (cutoff,)
+            )
+        for job_id in expired:
+            remove_if_exists(job_output_path(job_id))
+    
+    # 提交和取消
+    async def submit(self, kind: str, params: dict, submitted_by: str) -> dict:
+        now = datetime.now().timestamp()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "params": params,
+            "status": "pending",
+            "progress_done": 0,
+            "progress_total": 0,
+            "message": None,
+            "result": None,
+            "error": None,
+            "submitted_by": submitted_by,
+            "created_at": now,
+            "updated_at": now
+        }
+        await run_io(self.save, job)
+        self.queue.put_nowait(job["id"])
+        return job
+    
+    async def cancel(self, job_id: str) -> Optional[dict]:
+        job = await run_io(self.get, job_id)
+        if job is None or job["status"] in JOB_FINISHED_STATUSES:
+            return job
+        if job["status"] == "pending":
+            job["status"] = "cancelled"
+            await run_io(self.save, job)
+            self.publish(job)
+        else:
+            # 运行中的任务在下一次检查时退出
+            self.cancel_requested.add(job_id)
+        return job
+    
+    # 执行
+    async def _runner(self):
+        while True:
+            job_id = await self.queue.get()
+            job = await run_io(self.get, job_id)
+            if job is None or job["status"] != "pending":
+                continue
+            handler = JOB_HANDLERS[job["kind"]]
+            job["status"] = "running"
+            await run_io(self.save, job)
+            self.publish(job)
+            
+            context = JobContext(self, job)
+            try:
+                job["result"] = await self.loop.run_in_executor(self.executor, handler, context, job["params"])
+                job["status"] = "completed"
+                job["progress_done"] = max(job["progress_done"], job["progress_total"])
+            except JobCancelled:
+                if self.stopping:
+                    raise asyncio.CancelledError()
+                job["status"] = "cancelled"
+            except HTTPException as e:
+                job["status"] = "failed"
+                job["error"] = e.detail
+            except Exception as e:
+                print(f"后台任务 {job_id} ({job['kind']}) 失败: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+            finally:
+                self.cancel_requested.discard(job_id)
+            await run_io(self.save, job)
+            self.publish(job)
+    
+    # 进度推送
+    def subscribe(self, job_id: str, outbox: WebSocketOutbox):
+        self.subscribers[job_id].add(outbox)
+    
+    def unsubscribe(self, outbox: WebSocketOutbox, job_id: Optional[str] = None):
+        job_ids = [job_id] if job_id else list(self.subscribers)
+        for key in job_ids:
+            outboxes = self.subscribers.get(key)
+            if outboxes is not None:
+                outboxes.discard(outbox)
+                if not outboxes:
+                    del self.subscribers[key]
+    
+    def publish_threadsafe(self, job: dict):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.publish, dict(job))
+    
+    def publish(self, job: dict):
+        outboxes = self.subscribers.get(job["id"])
+        if not outboxes:
+            return
+        # 进度帧放入订阅连接的发送队列，同一任务的进度可以合并为最新一条
+        frame = encode_ws_message({"type": "job_progress", "job": self.to_public(job)})
+        for outbox in list(outboxes):
+            if not outbox.send_text(frame, coalesce_key=f"job:{job['id']}"):
+                self.unsubscribe(outbox)
+        if job["status"] in JOB_FINISHED_STATUSES:
+            self.subscribers.pop(job["id"], None)
+
+def job_output_path(job_id: str) -> str:
+    return os.path.join(JOB_OUTPUT_DIR, f"{job_id}.zip")
+
+def resolve_job_folder(folder_path: str) -> str:
+    """任务参数中的文件夹路径，必须是上传目录下已存在的文件夹"""
+    full_path = resolve_upload_file(folder_path or "")
+    if not os.path.isdir(full_path):
+        raise HTTPException(status_code=404, detail="文件夹不存在")
+    return full_path
+
+# 任务实现：在任务线程中执行，定期检查取消；中断后重新执行必须是安全的
+def job_delete_folder(context: JobContext, params: dict) -> dict:
+    """把文件夹移到回收站，与 DELETE /folders 相同（移入回收站是一次重命名，很快完成）"""
+    folder_path = normalize_relative_path(params["folder_path"])
+    if not folder_path:
+        raise HTTPException(status_code=400, detail="不能删除上传根目录")
+    if context.job["result"] and context.job["result"].get("trash_id"):
+        # 重启前已经移入回收站
+        return context.job["result"]
+    result = delete_folder_sync(folder_path, context.job["submitted_by"])
+    context.progress(1, 1, state=result, force=True)
+    return result
+
+def job_zip_folder(context: JobContext, params: dict) -> dict:
+    """把文件夹打包为ZIP文件，完成后通过 /jobs/{job_id}/result 下载"""
+    folder_path = normalize_relative_path(params.get("folder_path", ""))
+    full_path = resolve_job_folder(folder_path)
+    row = file_index.get(folder_path) if folder_path else None
+    total = row["size"] if row is not None else 0
+    
+    output_path = job_output_path(context.job_id)
+    tmp_path = output_path + ".tmp"
+    written = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in iter_folder_zip(full_path):
+                context.check_cancelled()
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+                    context.progress(written, max(total, written))
+        os.replace(tmp_path, output_path)
+    finally:
+        remove_if_exists(tmp_path)
+    
+    archive_name = (os.path.basename(folder_path) or "uploads") + ".zip"
+    return {
+        "folder_path": folder_path,
+        "filename": archive_name,
+        "size": written,
+        "download_url": f"/jobs/{context.job_id}/result"
+    }
+
+def set_metadata_sha256(full_path: str, sha256: str):
+    """把哈希写入文件的 .meta 元数据（外部放入的文件没有 .meta 时创建）"""
+    metadata = read_file_metadata(full_path)
+    if not metadata:
+        metadata = {
+            "filename": os.path.basename(full_path),
+            "original_name": os.path.basename(full_path),
+            "file_size": os.path.getsize(full_path)
+        }
+    metadata["sha256"] = sha256
+    with open(full_path + ".meta", "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False)
+
+def job_hash_files(context: JobContext, params: dict) -> dict:
+    """计算文件或文件夹中所有文件的SHA-256，放入去重存储并写入元数据
+    
+    默认只处理还没有哈希的文件（例如直接放入上传目录的文件），rehash=true 时全部重新计算
+    """
+    path = normalize_relative_path(params.get("path", ""))
+    full_path = resolve_upload_file(path)
+    if not os.path.exists(full_path):
+        raise HTTPException(status_code=404, detail="文件或文件夹不存在")
+    rehash = bool(params.get("rehash"))
+    
+    with file_index.lock:
+        sql = "SELECT path, size, sha256 FROM files WHERE type = 'file'"
+        args = ()
+        if path:
+            sql += " AND (path = ? OR (path >= ? AND path < ?))"
+            args = (path, path + "/", path + "0")
+        if not rehash:
+            sql += " AND sha256 IS NULL"
+        rows = [tuple(row) for row in file_index.conn.execute(sql + " ORDER BY path", args)]
+    
+    total = sum(size for _, size, _ in rows)
+    done = 0
+    hashed = 0
+    deduplicated = 0
+    results = {}
+    for relative_path, size, _ in rows:
+        context.check_cancelled()
+        file_path = os.path.join(UPLOAD_DIR, relative_path)
+        if not os.path.isfile(file_path):
+            continue
+        
+        def on_chunk(length: int):
+            nonlocal done
+            done += length
+            context.progress(done, total, message=relative_path)
+            context.check_cancelled()
+        sha256 = hash_file(file_path, on_chunk)
+        if store_blob(file_path, sha256):
+            deduplicated += 1
+        set_metadata_sha256(file_path, sha256)
+        file_index.upsert(relative_path)
+        hashed += 1
+        if len(results) < 100:
+            results[relative_path] = sha256
+    return {"path": path, "hashed": hashed, "deduplicated": deduplicated, "sha256": results}
+
+def job_batch(context: JobContext, params: dict) -> dict:
+    """后台执行批量操作，每完成一项保存一次，重启后从下一项继续"""
+    operations = params["operations"]
+    state = context.job["result"] or {"succeeded": 0, "failed": []}
+    start = context.job["progress_done"]
+    with defer_file_change_notifications():
+        for index in range(start, len(operations)):
+            context.check_cancelled()
+            operation = operations[index]
+            try:
+                run_batch_operation(operation, context.job["submitted_by"])
+                state["succeeded"] += 1
+            except HTTPException as e:
+                state["failed"].append({"index": index, "op": operation.get("op"), "error": e.detail})
+            except Exception as e:
+                state["failed"].append({"index": index, "op": operation.get("op"), "error": str(e)})
+            context.progress(index + 1, len(operations), state=state, force=True)
+    return state
+
+JOB_HANDLERS = {
+    "delete_folder": job_delete_folder,
+    "zip": job_zip_folder,
+    "hash": job_hash_files,
+    "batch": job_batch
+}
+
+job_engine = JobEngine(JOBS_DB, JOB_WORKERS)
+
+def job_needs_admin(kind: str, params: dict) -> bool:
+    """删除文件夹、包含删除操作的批量任务只有管理员可以提交或取消"""
+    if kind == "delete_folder":
+        return True
+    if kind == "batch":
+        operations = params.get("operations") or []
+        return any(isinstance(o, dict) and o.get("op") in BATCH_ADMIN_OPERATIONS for o in operations)
+    return False
+
+@app.post("/jobs")
+async def submit_job(request: Request, admin_session_id: str = None):
+    """提交后台任务，立即返回任务ID
+    
+    请求体: {"kind": "delete_folder" | "zip" | "hash" | "batch", "params": {...}}
+    - delete_folder: {"folder_path"}，仅管理员
+    - zip: {"folder_path"}
+    - hash: {"path", "rehash"}
+    - batch: {"operations": [...]}，格式同 /batch，包含删除时仅管理员
+    """
+    try:
+        payload = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="请求体必须是JSON")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="请求体必须是JSON对象")
+    kind = payload.get("kind")
+    params = payload.get("params") or {}
+    if kind not in JOB_HANDLERS:
+        raise HTTPException(status_code=400, detail=f"不支持的任务类型: {kind}")
+    if not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail="params 必须是JSON对象")
+    
+    if kind == "delete_folder" and not params.get("folder_path"):
+        raise HTTPException(status_code=400, detail="缺少参数: folder_path")
+    if kind == "batch":
+        operations = params.get("operations")
+        if not isinstance(operations, list) or not operations or not all(isinstance(o, dict) for o in operations):
+            raise HTTPException(status_code=400, detail="operations 必须是非空的对象列表")
+    if job_needs_admin(kind, params) and not is_admin_request(request, admin_session_id or payload.get("admin_session_id")):
+        raise HTTPException(status_code=403, detail="权限不足，只有管理员才能删除文件或文件夹")
+    
+    job = await job_engine.submit(kind, params, get_real_client_ip(request=request))
+    return job_engine.to_public(job)
+
+@app.get("/jobs")
+async def list_jobs(limit: int = 50):
+    """最近的后台任务"""
+    limit = max(1, min(limit, 200))
+    jobs = await run_io(job_engine.list_recent, limit)
+    return {"jobs": [job_engine.to_public(job) for job in jobs]}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询任务状态和进度"""
+    job = await run_io(job_engine.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job_engine.to_public(job)
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, request: Request, admin_session_id: str = None):
+    """取消排队中或运行中的任务（提交时需要管理员权限的任务，取消时同样需要）"""
+    job = await run_io(job_engine.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if job_needs_admin(job["kind"], job["params"] or {}) and not is_admin_request(request, admin_session_id):
+        raise HTTPException(status_code=403, detail="权限不足，只有管理员才能取消删除任务")
+    job = await job_engine.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job_engine.to_public(job)
+
+@app.api_route("/jobs/{job_id}/result", methods=["GET", "HEAD"])
+async def download_job_result(job_id: str, request: Request):
+    """下载任务生成的文件（ZIP打包任务）"""
+    job = await run_io(job_engine.get, job_id)
+    if job is None or job["status"] != "completed" or job["kind"] != "zip":
+        raise HTTPException(status_code=404, detail="任务结果不存在")
+    output_path = job_output_path(job_id)
+    if not await run_io(os.path.exists, output_path):
+        raise HTTPException(status_code=404, detail="任务结果已过期")
+    return await run_io(build_file_response, request, output_path, "application/zip", download_name=job["result"]["filename"])
+
+@app.get("/metrics/io")
+async def io_metrics():
+    """文件I/O线程池的排队深度和延迟统计"""
+    return io_executor.snapshot()
+
 # 添加健康检查端点
 @app.get("/health")
 async def health_check():
@@ -1425,24 +4894,16 @@ async def admin_clear_history(request: Request):
     
     try:
         # 清空服务器端的所有历史记录
-        global global_chat_history, private_chat_storage
-        global_chat_history = []
-        private_chat_storage = defaultdict(list)
+        await clear_chat_history()
         
-        # 删除历史文件
+        # 删除旧版本的历史文件
         files_deleted = []
-        if os.path.exists(GROUP_HISTORY_FILE):
-            os.remove(GROUP_HISTORY_FILE)
+        if await run_io(remove_if_exists, GROUP_HISTORY_FILE):
             files_deleted.append("群聊历史文件")
             
-        if os.path.exists(PRIVATE_HISTORY_FILE):
-            os.remove(PRIVATE_HISTORY_FILE)
+        if await run_io(remove_if_exists, PRIVATE_HISTORY_FILE):
             files_deleted.append("私聊历史文件")
         
-        # 创建新的空历史文件
-        await save_group_history()
-        await save_private_history()
-        
         print(f"管理员 {client_ip} 清空了所有聊天历史记录")
         
         # 广播管理员操作消息给所有连接的用户
@@ -1482,13 +4943,14 @@ async def websocket_endpoint_simple(websocket: WebSocket):
     # 获取客户端IP
     client_ip = get_real_client_ip(websocket=websocket)
     connection_id = str(uuid.uuid4())
+    # 重连时客户端带上最后收到的消息序号，只补发之后的消息
+    try:
+        since = int(websocket.query_params["since"]) if websocket.query_params.get("since") else None
+    except ValueError:
+        since = None
     
     # 添加到连接管理器
-    simple_connections[connection_id] = {
-        'websocket': websocket,
-        'ip': client_ip,
-        'connected_at': datetime.now()
-    }
+    outbox = add_simple_connection(connection_id, websocket, client_ip)
     
     print(f"Simple WebSocket connection from IP: {client_ip}")
     
@@ -1516,23 +4978,48 @@ async def websocket_endpoint_simple(websocket: WebSocket):
         await broadcast_simple_message(join_message, exclude_id=connection_id)
         
         # 发送聊天历史给新用户（包括群聊和相关私聊）
-        await send_chat_history(websocket, client_ip)
+        await send_chat_history(websocket, client_ip, since)
         
+    except asyncio.CancelledError:
+        # 发送历史期间因太慢被断开
+        if not outbox.closed:
+            raise
     except Exception as e:
         print(f"Error sending welcome message or history: {e}")
     
+    # 历史发送完后启动发送队列，之后所有消息都经由队列按顺序发出
+    outbox.start()
+    
     try:
-        while True:
+        while not outbox.closed:
             data = await websocket.receive_json()
+            # 连接已被移除（太慢被断开或发送失败），不再处理它发来的消息
+            if outbox.closed:
+                break
             print(f"Message from {client_ip}: {data}")
             
+            # 订阅后台任务进度
+            if data.get('type') in ('job_subscribe', 'job_unsubscribe'):
+                job_id = str(data.get('job_id', ''))
+                if data['type'] == 'job_unsubscribe':
+                    job_engine.unsubscribe(outbox, job_id)
+                    continue
+                job = await run_io(job_engine.get, job_id)
+                if job is None:
+                    outbox.send_json({'type': 'job_error', 'job_id': job_id, 'message': '任务不存在'})
+                    continue
+                if job['status'] not in JOB_FINISHED_STATUSES:
+                    job_engine.subscribe(job_id, outbox)
+                outbox.send_json({'type': 'job_progress', 'job': job_engine.to_public(job)}, coalesce_key=f"job:{job_id}")
+                continue
+            
             # 处理管理员操作
             if data.get('type') == 'admin_action' and data.get('action') == 'clear_all_history':
                 print(f"收到管理员清空历史记录操作，来自IP: {client_ip}")
                 
                 # 验证管理员权限
                 if client_ip != admin_ip:
-                    await websocket.send_json({
+                    outbox.send_json({
                         'type': 'system',
                         'message': '权限不足，只有管理员才能执行此操作',
                         'ip': 'system',
@@ -1541,17 +5028,13 @@ async def websocket_endpoint_simple(websocket: WebSocket):
                     continue
                 
                 # 清空服务器端的所有历史记录
-                global global_chat_history, private_chat_storage
-                global_chat_history = []
-                private_chat_storage = defaultdict(list)
+                await clear_chat_history()
                 
-                # 删除历史文件
+                # 删除旧版本的历史文件
                 try:
-                    if os.path.exists(GROUP_HISTORY_FILE):
-                        os.remove(GROUP_HISTORY_FILE)
+                    if await run_io(remove_if_exists, GROUP_HISTORY_FILE):
                         print("群聊历史文件已删除")
-                    if os.path.exists(PRIVATE_HISTORY_FILE):
-                        os.remove(PRIVATE_HISTORY_FILE)
+                    if await run_io(remove_if_exists, PRIVATE_HISTORY_FILE):
                         print("私聊历史文件已删除")
                 except Exception as e:
                     print(f"删除历史文件失败: {e}")
@@ -1587,12 +5070,14 @@ async def websocket_endpoint_simple(websocket: WebSocket):
                 # 私聊消息 - 发送给目标IP和发送者，并保存到历史
                 await broadcast_private_message(message_data, data['targetIp'], connection_id)
             else:
-                # 群聊消息 - 广播给所有连接并保存到历史记录
-                await broadcast_simple_message(message_data, exclude_id=connection_id)
-                
-                # 保存到全局历史记录（只有群聊消息）
+                # 群聊消息 - 先保存到全局历史记录（分配序号），再广播给所有连接
                 add_to_global_history(message_data)
+                await broadcast_simple_message(message_data, exclude_id=connection_id)
             
+    except asyncio.CancelledError:
+        if not outbox.closed:
+            raise
+        print(f"慢连接 {client_ip} 已断开")
     except Exception as e:
         print(f"WebSocket error for {client_ip}: {e}")
     finally:
@@ -1609,8 +5094,8 @@ async def websocket_endpoint_simple(websocket: WebSocket):
             print(f"Error sending leave message: {e}")
         
         # 清理连接
-        if connection_id in simple_connections:
-            del simple_connections[connection_id]
+        job_engine.unsubscribe(outbox)
+        remove_simple_connection(connection_id)
         print(f"Client {client_ip} disconnected")
 
 # 添加应用启动事件
@@ -1620,14 +5105,23 @@ async def startup_event():
     print("正在启动聊天服务器...")
     await load_chat_history()
     print("聊天历史加载完成")
+    await run_io(cleanup_expired_resumable_uploads)
+    await run_io(gc_orphan_blobs)
+    stats = await run_io(file_index.reconcile)
+    print(f"文件索引同步完成: 共 {stats['total']} 项, 更新 {stats['changed']} 项, 删除 {stats['removed']} 项")
+    await file_watcher.start()
+    await job_engine.start()
+    trash_purger.start()
 
 # 添加应用关闭事件
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时保存数据"""
+    file_watcher.stop()
+    job_engine.stop()
+    trash_purger.stop()
     print("正在保存聊天历史...")
-    await save_group_history()
-    await save_private_history()
+    await chat_store.close()
     print("数据保存完成")
 
 # 添加获取IP名称映射的端点
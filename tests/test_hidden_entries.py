@@ -0,0 +1,59 @@
+"""回收站、数据块存储和未完成的上传都在 uploads/ 下，不能通过 /download 和 /uploads 访问"""
+import importlib
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def app_client(tmp_path, monkeypatch):
+    # 应用使用相对路径（uploads/、database/），在临时目录中运行，不影响仓库中的数据
+    for name in ("image", "templates", "database"):
+        os.makedirs(tmp_path / name)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(REPO_DIR)
+    sys.modules.pop("main", None)
+    main = importlib.import_module("main")
+
+    async def as_admin(scope, receive, send):
+        # 删除文件需要管理员IP
+        if scope["type"] in ("http", "websocket"):
+            scope = dict(scope, client=(main.admin_ip, 50000))
+        await main.app(scope, receive, send)
+
+    with TestClient(as_admin) as client:
+        yield main, client
+    sys.modules.pop("main", None)
+
+
+def test_deleted_file_is_not_downloadable(app_client):
+    main, client = app_client
+    response = client.post("/upload", files={"file": ("b.txt", b"secret")}, data={"custom_filename": "b.txt"})
+    assert response.status_code == 200
+    assert client.get("/download/b.txt").content == b"secret"
+
+    trash_id = client.delete("/files/b.txt").json()["trash_id"]
+
+    assert client.get("/download/.trash").status_code == 404
+    assert client.get(f"/download/.trash/{trash_id}/b.txt").status_code == 404
+    assert client.get(f"/uploads/.trash/{trash_id}/b.txt").status_code == 404
+    assert client.get(f"/uploads/.trash/{trash_id}.json").status_code == 404
+    assert client.get("/download/sub/../.trash").status_code == 404
+
+
+def test_internal_stores_are_not_downloadable(app_client):
+    main, client = app_client
+    client.post("/upload", files={"file": ("c.txt", b"content")}, data={"custom_filename": "c.txt"})
+
+    assert client.get("/download/").status_code == 404
+    assert client.get("/download/sub/..").status_code == 404
+    assert client.head("/download/").status_code == 404
+    assert client.get("/uploads/").status_code == 404
+    assert client.get("/download/.blobs").status_code == 404
+    assert client.get("/download/.partial").status_code == 404
+    assert client.get("/uploads/c.txt.meta").status_code == 404
+    assert client.get("/uploads/c.txt").content == b"content"